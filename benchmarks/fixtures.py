@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+""" fixtures.py
+Fixture pages and torrents for the benchmarks, modelled on the markup of the
+tracker's details.php, browse.php and history.php pages. Result pages of any
+size can be built from them.
+"""
+
+import os.path
+
+GENRES = (u'Drama', u'Arthouse', u'Comedy', u'Western', u'Documentary',
+          u'Film Noir', u'Horror', u'Musical')
+COUNTRIES = (u'Germany', u'France', u'Japan', u'USA', u'Italy', u'Sweden')
+
+RESULT_PAGE = u"""<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN">
+<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+<title>KG - %(title)s</title>
+<link rel="stylesheet" href="default.css" type="text/css">
+</head>
+<body>
+<table class="mainouter" width="100%%" border="1" cellspacing="0" cellpadding="10">
+<tr><td class="outer" align="center">
+<h1>%(title)s</h1>
+<p align="center">%(pager)s</p>
+<table id="browse" border="1" cellspacing="0" cellpadding="5">
+<tr><td class="colhead">Type</td><td class="colhead">Name</td><td class="colhead">Director</td><td class="colhead">Year</td><td class="colhead">Genres</td><td class="colhead">Country</td></tr>
+%(rows)s
+</table>
+<p align="center">%(pager)s</p>
+</td></tr>
+</table>
+</body>
+</html>
+"""
+
+RESULT_ROW = u"""<tr>
+<td align="center"><div style="position:relative"><a href="browse.php?cat=1"><img border="0" width="40" height="40" src="pic/cat_movie.gif" title="Movie: %(genre)s"></a></div></td>
+<td align="left"><span class="title"><a href="details.php?id=%(kg_id)d&amp;hit=1"><b>%(title)s</b></a></span><br>%(filename)s &nbsp;&middot;&nbsp; 700 MB</td>
+<td align="left"><a href="browse.php?search=%(director)s&amp;search_type=director">%(director)s</a></td>
+<td align="center"><a href="browse.php?year=%(year)s">%(year)s</a></td>
+<td align="left">%(genres)s</td>
+<td align="center"><a href="browse.php?country=%(country_id)d"><img src="pic/flag/%(country_id)d.gif" alt="%(country)s" border="0"></a></td>
+</tr>
+<tr><td colspan="6" class="spacer"></td></tr>
+"""
+
+GENRE_LINK = u"""<a href="browse.php?genre=%d">%s</a>"""
+
+DETAILS_PAGE = u"""<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN">
+<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+<title>KG - %(title)s (%(year)s) </title>
+</head>
+<body>
+<table class="main" border="0" cellspacing="0" cellpadding="0">
+<tr><td class="outer"><h1>%(title)s <img src="pic/flag/1.gif" alt="%(country)s"></h1></td></tr>
+</table>
+<table width="750" border="1" cellspacing="0" cellpadding="5">
+<tr><td colspan="2" class="colhead">Details</td></tr>
+<tr><td class="rowhead" width="1%%">Download</td><td width="99%%" align="left"><a class="index" href="down.php/%(kg_id)d/%(torrent)s">%(torrent)s</a></td></tr>
+<tr><td class="heading" valign="top" align="right">Internet Link</td><td valign="top" align="left"><a target="_blank" href="http://www.imdb.com/title/tt%(imdb_id)07d/">http://www.imdb.com/title/tt%(imdb_id)07d/</a></td></tr>
+<tr><td class="heading" valign="top" align="right">Director / Artist</td><td valign="top" align="left"><a href="browse.php?search=%(director)s&amp;search_type=director">%(director)s</a></td></tr>
+<tr><td class="heading" valign="top" align="right">Year</td><td valign="top" align="left"><a href="browse.php?year=%(year)s">%(year)s</a></td></tr>
+<tr><td class="heading" valign="top" align="right">Genres</td><td valign="top" align="left">%(genres)s</td></tr>
+<tr><td class="heading" valign="top" align="right">Language</td><td valign="top" align="left">German</td></tr>
+<tr><td class="heading" valign="top" align="right">Subtitles</td><td valign="top" align="left">English (included)</td></tr>
+<tr><td class="heading" valign="top" align="right">Source</td><td valign="top" align="left">DVD</td></tr>
+<tr><td class="heading" valign="top" align="right">Description</td><td valign="top" align="left">%(description)s</td></tr>
+</table>
+</body>
+</html>
+"""
+
+
+def item_details(kg_id):
+    """ Returns a dictionary with the details of the fixture item with the
+        given id.
+    """
+    kg_id = int(kg_id)
+    return {'kg_id': kg_id,
+            'title': u'Orig\xedginal Title %d aka Alternative Title %d'
+                     % (kg_id, kg_id),
+            'director': u'Director %d' % (kg_id % 997),
+            'year': u'%d' % (1920 + kg_id % 90),
+            'genres': (GENRES[kg_id % len(GENRES)],
+                       GENRES[(kg_id + 3) % len(GENRES)]),
+            'country': COUNTRIES[kg_id % len(COUNTRIES)],
+            'country_id': kg_id % len(COUNTRIES) + 1,
+            'imdb_id': 10000 + kg_id,
+            'filename': u'Original.Title.%d.DVDRip.XviD.avi' % kg_id}
+
+
+def result_page(kg_ids, page_num, last_page, script='history.php'):
+    """ Returns a result page listing the fixture items with the given ids,
+        linking to the pages up to `last_page`.
+    """
+    rows = []
+    for kg_id in kg_ids:
+        details = item_details(kg_id)
+        details['genres'] = u' '.join(
+            GENRE_LINK % (GENRES.index(x), x) for x in details['genres'])
+        details['genre'] = GENRES[kg_id % len(GENRES)]
+        rows.append(RESULT_ROW % details)
+    pager = u' | '.join(
+        (u'<a href="%s?id=29027&amp;rcompsort=1&amp;page=%d"><b>%d</b></a>'
+         % (script, x, x + 1)) if x != page_num else u'<b>%d</b>' % (x + 1)
+        for x in range(last_page + 1))
+    return (RESULT_PAGE % {'title': script, 'pager': pager,
+                           'rows': u''.join(rows)}).encode('utf8')
+
+
+def details_page(kg_id, multi_file=False):
+    """ Returns the details page of the fixture item with the given id. Its
+        torrent contains a single file named like the torrent, unless
+        `multi_file` is set.
+    """
+    details = item_details(kg_id)
+    details['genres'] = u', '.join(
+        GENRE_LINK % (GENRES.index(x), x) for x in details['genres'])
+    if multi_file:
+        details['torrent'] = u'Original Title %d DVD9.torrent' % kg_id
+    else:
+        details['torrent'] = details['filename'] + u'.torrent'
+    details['description'] = u'Lorem ipsum dolor sit amet. ' * 40
+    return (DETAILS_PAGE % details).encode('utf8')
+
+
+def torrent(kg_id, num_files=1, num_pieces=20000):
+    """ Returns a bencoded torrent of the fixture item with the given id.
+        Torrents with more than one file contain a DVD structure.
+    """
+    details = item_details(kg_id)
+    info = {'name': details['filename'].encode('utf8'),
+            'piece length': 262144,
+            'pieces': '\x8f' * 20 * num_pieces}
+    if num_files > 1:
+        info['name'] = ('Original Title %d DVD9' % kg_id).encode('utf8')
+        info['files'] = [
+            {'length': 1073741824,
+             'path': ['VIDEO_TS', 'VTS_%02d_%d.VOB' % (x // 9 + 1, x % 9 + 1)]}
+            for x in range(num_files)]
+    else:
+        info['length'] = 734003200
+    return bencode({'announce': 'http://tracker.example.org/announce',
+                    'info': info})
+
+
+def multi_file_names(kg_id, num_files):
+    """ Returns the names of the files in the multi-file fixture torrent. """
+    name = u'Original Title %d DVD9' % kg_id
+    return [name] + [os.path.join(name, u'VIDEO_TS',
+                                  u'VTS_%02d_%d.VOB' % (x // 9 + 1, x % 9 + 1))
+                     for x in range(num_files)]
+
+
+def bencode(value):
+    """ Bencodes the given value. """
+    if isinstance(value, (int, long)):
+        return 'i%de' % value
+    elif isinstance(value, str):
+        return '%d:%s' % (len(value), value)
+    elif isinstance(value, list):
+        return 'l%se' % ''.join(bencode(x) for x in value)
+    elif isinstance(value, dict):
+        return 'd%se' % ''.join(bencode(key) + bencode(value[key])
+                                for key in sorted(value))
+    raise TypeError("Can't bencode %r" % value)
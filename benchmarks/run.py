@@ -0,0 +1,218 @@
+""" run.py
+Offline benchmarks for the hot paths of pyragarga, using the fixture pages and
+a local stand-in for the tracker.
+
+    python benchmarks/run.py            # compare against benchmarks/baseline.json
+    python benchmarks/run.py --update   # store the current timings as baseline
+
+Exits with status 1 if any benchmark got slower than its baseline by more than
+the tolerance. The baseline records the options and the machine it was taken
+with, options not given are taken from it so that the timings are comparable.
+Timings taken on another machine can differ for that alone, store a baseline
+of your own with --update before comparing against it then. The timing of
+parsing in several processes depends on the number of CPUs, so it is only
+printed and never stored.
+"""
+
+import json
+import logging
+import optparse
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import fixtures
+from pyragarga import KGItem, LocalDatabase, Pyragarga
+from server import StandInTracker
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+
+# Options that determine the workload, with their defaults
+WORKLOAD_OPTIONS = {'pages': 20, 'items': 2000, 'files': 200, 'workers': 4}
+
+# Benchmarks that depend on the number of CPUs rather than on the code, which
+# are never stored in a baseline
+UNSTORED = ('get_snatched_pipeline',)
+
+
+def best_of(func, repeat, number=1):
+    """ Returns the shortest time in seconds that a call of `func` took,
+        running it `number` times in each of `repeat` rounds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        times.append((time.time() - start) / number)
+    return min(times)
+
+
+def make_items(num_items):
+    items = []
+    for kg_id in range(1, num_items + 1):
+        details = fixtures.item_details(kg_id)
+        item = KGItem(kg_id, imdb_id=details['imdb_id'],
+                      orig_title=details['title'],
+                      director=details['director'], year=details['year'],
+                      country=details['country'], genres=details['genres'])
+        item.files = [details['filename'], u'Subs/%d.srt' % kg_id]
+        items.append(item)
+    return items
+
+
+def run_benchmarks(options):
+    """ Runs all benchmarks and returns a dictionary mapping their names to
+        their timings in seconds.
+    """
+    results = {}
+    server = StandInTracker(num_pages=options.pages, rows_per_page=100,
+                            num_files=options.files).start()
+    tmp_dir = tempfile.mkdtemp(prefix='pyragarga-bench-')
+    try:
+        pyragarga = Pyragarga('user', 'password', url=server.url,
+                              max_workers=options.workers)
+        history_page = fixtures.result_page(server.page_ids(0), 0,
+                                            options.pages - 1)
+        details_page = fixtures.details_page(1)
+        torrent = fixtures.torrent(10, num_files=options.files)
+
+        results['build_tree'] = best_of(
+            lambda: pyragarga._build_tree(history_page), options.repeat, 5)
+
+        tree = pyragarga._build_tree(history_page)
+        table = list(tree.findall(".//table[@id='browse']"))[0]
+        assert len(pyragarga._parse_result_table(table)) == 100
+        results['parse_result_table'] = best_of(
+            lambda: pyragarga._parse_result_table(table), options.repeat, 5)
+
+        details_tree = pyragarga._build_tree(details_page)
+        assert pyragarga._parse_details_page(details_tree, 1).files
+        results['parse_details_page'] = best_of(
+            lambda: pyragarga._parse_details_page(details_tree, 1),
+            options.repeat, 20)
+
+        assert (pyragarga._get_files_from_torrent(torrent)
+                == fixtures.multi_file_names(10, options.files))
+        results['get_files_from_torrent'] = best_of(
+            lambda: pyragarga._get_files_from_torrent(torrent),
+            options.repeat, 20)
+
+        items = make_items(options.items)
+        databases = []
+        def store():
+            database = LocalDatabase(os.path.join(
+                tmp_dir, 'store%d.db' % len(databases)))
+            databases.append(database)
+            database.store_many(items)
+        results['db_store'] = best_of(store, options.repeat)
+        database = databases[-1]
+        kg_ids = [x.kg_id for x in items]
+        assert len(database.retrieve_many(kg_ids)) == len(items)
+        results['db_retrieve'] = best_of(
+            lambda: database.retrieve_many(kg_ids), options.repeat)
+
+        result = pyragarga.get_snatched(movies_only=False)
+        assert len(result) == options.pages * 100
+        results['get_snatched'] = best_of(
+            lambda: pyragarga.get_snatched(movies_only=False), options.repeat)
+
+        pyragarga.parse_processes = options.workers
+        assert ([x.kg_id for x in pyragarga.get_snatched(movies_only=False)]
+                == [x.kg_id for x in result])
+        results['get_snatched_pipeline'] = best_of(
+            lambda: pyragarga.get_snatched(movies_only=False), options.repeat)
+        pyragarga.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def describe_machine():
+    """ Returns a dictionary describing the machine and the Python version
+        the benchmarks run on.
+    """
+    return {'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpus': multiprocessing.cpu_count(),
+            'python': platform.python_version()}
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--update', action='store_true',
+                      help='store the timings as the new baseline')
+    parser.add_option('--baseline', default=BASELINE_FILE,
+                      help='file with the baseline timings')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='allowed slowdown relative to the baseline')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='number of rounds to take the best timing of')
+    parser.add_option('--pages', type='int',
+                      help='number of pages in the snatched history')
+    parser.add_option('--items', type='int',
+                      help='number of items stored in the database')
+    parser.add_option('--files', type='int',
+                      help='number of files in multi-file torrents')
+    parser.add_option('--workers', type='int')
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    stored = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            stored = json.load(baseline_file)
+    for (name, default) in WORKLOAD_OPTIONS.items():
+        if getattr(options, name) is None:
+            setattr(options, name,
+                    stored.get('options', {}).get(name, default))
+    workload = dict((x, getattr(options, x)) for x in WORKLOAD_OPTIONS)
+    machine = describe_machine()
+    baseline = {}
+    if stored and not options.update:
+        if stored['options'] != workload:
+            print('Not comparing against the baseline, which was taken with '
+                  'other options: %s' % stored['options'])
+        else:
+            baseline = stored['timings']
+            if stored['machine'] != machine:
+                print('The baseline was taken on another machine: %s'
+                      % stored['machine'])
+
+    results = run_benchmarks(options)
+    regressions = []
+    for name in sorted(results):
+        line = '%-24s %10.3f ms' % (name, results[name] * 1000)
+        if name in baseline:
+            change = results[name] / baseline[name] - 1
+            line += '  %+7.1f%%' % (change * 100)
+            if change > options.tolerance:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+    if options.update:
+        timings = dict((x, results[x]) for x in results if x not in UNSTORED)
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump({'machine': machine, 'options': workload,
+                       'timings': timings},
+                      baseline_file, indent=2, separators=(',', ': '),
+                      sort_keys=True)
+        print('Stored baseline in %s' % options.baseline)
+    elif not stored:
+        print('No baseline found, run with --update to store one')
+    if regressions and not options.update:
+        print('Slower than baseline: %s' % ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
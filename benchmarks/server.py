@@ -0,0 +1,153 @@
+""" server.py
+Local stand-in for the tracker that serves the fixture pages, so that
+Pyragarga can be benchmarked end to end without network access.
+"""
+
+import threading
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import fixtures
+
+
+class StandInTracker(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server that serves the fixture pages on localhost. The snatched
+        history of every user consists of `num_pages` pages with
+        `rows_per_page` items each, items whose id is divisible by 10 come
+        with multi-file torrents. The bookmarks consist of a single page
+        with `rows_per_page` items, half of them snatched. Pages are only
+        served to logged in users, others are redirected to the login page.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, num_pages=10, rows_per_page=100, num_files=50):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StandInHandler)
+        self.rows_per_page = rows_per_page
+        self.num_snatched = num_pages * rows_per_page
+        self.bookmark_ids = range(self.num_snatched + rows_per_page // 2,
+                                  self.num_snatched - rows_per_page // 2, -1)
+        # Scripts that answer every request with an error
+        self.unavailable = set()
+        self.num_files = num_files
+        self.requests = 0
+        self.logins = 0
+        # Sessions of earlier logins have expired
+        self.valid_from = 1
+        self.expires_after = None
+        self._thread = None
+
+    @property
+    def num_pages(self):
+        return -(-self.num_snatched // self.rows_per_page)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        """ Serves requests in a background thread. """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def expire_session(self, after=0):
+        """ Makes the current session expire once `after` more requests
+            have been served.
+        """
+        self.expires_after = self.requests + after
+
+    def snatch(self, count):
+        """ Adds `count` newly snatched items to the top of the history. """
+        self.num_snatched += count
+
+    def page_ids(self, page_num):
+        """ Returns the ids of the items on the given history page. """
+        last_id = self.num_snatched - page_num * self.rows_per_page
+        return range(last_id, max(last_id - self.rows_per_page, 0), -1)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.server.requests += 1
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.logins += 1
+        self.send_response(302)
+        self.send_header('Set-Cookie', 'uid=29027; path=/')
+        self.send_header('Set-Cookie', 'pass=%d; path=/' % self.server.logins)
+        self.send_header('Location', '/index.php')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests += 1
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        script = url.path.lstrip('/')
+        if script == 'login.php':
+            return self._send('<html><body><form action="takelogin.php">'
+                              '</form></body></html>')
+        if not self._logged_in():
+            self.send_response(302)
+            self.send_header('Location', '/login.php?returnto=%s'
+                             % urllib.quote(self.path))
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        if script in self.server.unavailable:
+            return self.send_error(503)
+        if script == 'bookmarks.php':
+            if int(params.get('page', 0)) > 0:
+                return self.send_error(404)
+            self._send(fixtures.result_page(self.server.bookmark_ids, 0, 0,
+                                            script=script))
+        elif script in ('history.php', 'browse.php'):
+            page_num = int(params.get('page', 0))
+            if page_num >= self.server.num_pages:
+                return self.send_error(404)
+            self._send(fixtures.result_page(self.server.page_ids(page_num),
+                                            page_num,
+                                            self.server.num_pages - 1,
+                                            script=script))
+        elif script == 'details.php':
+            kg_id = int(params['id'])
+            self._send(fixtures.details_page(kg_id,
+                                             multi_file=kg_id % 10 == 0))
+        elif script.startswith('down.php/'):
+            kg_id = int(script.split('/')[1])
+            self._send(fixtures.torrent(kg_id, self.server.num_files),
+                       content_type='application/x-bittorrent')
+        elif script == 'index.php':
+            self._send('<html><body>Welcome</body></html>')
+        else:
+            self.send_error(404)
+
+    def _logged_in(self):
+        server = self.server
+        if (server.expires_after is not None
+                and server.requests > server.expires_after):
+            # Only the sessions of later logins are valid from now on
+            server.expires_after = None
+            server.valid_from = server.logins + 1
+        cookies = dict(x.strip().split('=', 1) for x in
+                       self.headers.get('Cookie', '').split(';') if '=' in x)
+        return (cookies.get('pass', '').isdigit() and
+                int(cookies['pass']) >= server.valid_from)
+
+    def _send(self, body, content_type='text/html; charset=utf-8'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -5,11 +5,24 @@ bookmarked items, etc.
 """
 # TODO: Add logging
 
+import ast
+import bisect
+import collections
+import contextlib
+import hashlib
+import json
 import logging
+import multiprocessing
 import re
 import sys
+import os
 import os.path
 import sqlite3
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+from HTMLParser import HTMLParser
 
 # ElementTree 1.3 is required for its handling of more advanced XPath
 # expressions. As it's only available in the standard library from Python 2.7
@@ -20,11 +33,17 @@ else:
     import cElementTree as ET
 
 import requests
-from tidylib import tidy_document
-from bencode import bdecode
+# lxml parses the tracker's markup straight into a tree without namespaces, so
+# we only have to tidy it and fix the tags ourselves if it's not available.
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+    from tidylib import tidy_document
 
 KG_URL = 'https://karagarga.net/'
 LOGIN_SCRIPT = 'takelogin.php'
+LOGIN_PAGE = 'login.php'
 BROWSE_SCRIPT = 'browse.php'
 DETAILS_SCRIPT = 'details.php'
 HISTORY_SCRIPT = 'history.php'
@@ -37,11 +56,46 @@ GENRE_REXP = re.compile(r"^.*browse.php\?genre=(\d*).*")
 IMDB_ID_REXP = re.compile(r"^.*http://www.imdb.com/title/tt(\d*).*")
 FILENAME_REXP = re.compile(r"(.*\.avi|AVI|mkv|MKV)\.torrent$")
 
+# Status codes of responses to requests that are worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Size of the chunks result pages are read in when streaming them
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Extensions of the files in a media library that are matched to items
+MEDIA_EXTENSIONS = ('.avi', '.mkv', '.mp4', '.m4v', '.ogm', '.mpg', '.mpeg',
+                    '.vob', '.ifo', '.m2ts', '.mov', '.wmv', '.flv', '.divx')
+# Directories whose files belong to the torrent named like their parent
+DISC_DIRECTORIES = ('VIDEO_TS', 'AUDIO_TS', 'BDMV', 'CD1', 'CD2')
+
+_logger = logging.getLogger('pyragarga.Pyragarga')
+
+# Shared instances of strings that repeat across many items, e.g. the names
+# of directors, countries and genres
+_string_pool = {}
+
+
+def _pooled(value):
+    """ Returns the shared instance of the given string. """
+    if value is None:
+        return None
+    return _string_pool.setdefault(value, value)
+
+
 class KGItem(object):
 
+    __slots__ = ('kg_id', 'imdb_id', 'orig_title', 'aka_title', 'director',
+                 'year', 'country', 'torrent', 'genres', 'files', 'source',
+                 'subtitles', 'language', 'media_type')
+
+    # Attributes whose values repeat across many items, so that they are
+    # taken from the string pool
+    pooled_attributes = frozenset(['director', 'year', 'country', 'source',
+                                   'subtitles', 'language', 'media_type'])
+
     def __init__(self, kg_id, imdb_id=None, orig_title=None, aka_title=None,
                  director=None, year=None, country=None, torrent=None,
-                 genres=[], source=None, subtitles=None, language=None,
+                 genres=(), source=None, subtitles=None, language=None,
                  media_type=None):
         """ Initialize object with the item's Karagarga ID. """
         self.kg_id = int(kg_id)
@@ -60,9 +114,307 @@ class KGItem(object):
         self.language = language
         self.media_type = media_type
 
+    def __setattr__(self, name, value):
+        if name in KGItem.pooled_attributes:
+            value = _pooled(value)
+        elif name == 'genres':
+            value = tuple(_pooled(x) for x in value or ())
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        return tuple(getattr(self, x) for x in KGItem.__slots__)
+
+    def __setstate__(self, state):
+        for (name, value) in zip(KGItem.__slots__, state):
+            setattr(self, name, value)
+
     def __repr__(self):
         return "<KGItem \"%s\" with id %d>" % (self.orig_title, self.kg_id)
 
+
+class ItemTable(object):
+    """ Container for many items that keeps each attribute in a list of its
+        own instead of keeping an object for every item. Items are only
+        created when they are accessed.
+    """
+
+    def __init__(self, items=()):
+        self._columns = dict((x, []) for x in KGItem.__slots__)
+        self.extend(items)
+
+    def append(self, item):
+        for name in KGItem.__slots__:
+            value = getattr(item, name)
+            if name == 'files':
+                value = tuple(value)
+            self._columns[name].append(value)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def column(self, name):
+        """ Returns the list with the values of the given attribute for all
+            items, it must not be modified.
+        """
+        return self._columns[name]
+
+    def __len__(self):
+        return len(self._columns['kg_id'])
+
+    def __getitem__(self, index):
+        item = KGItem.__new__(KGItem)
+        item.__setstate__([self._columns[x][index] for x in KGItem.__slots__])
+        item.files = list(item.files)
+        return item
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+
+class ExtractionPlan(object):
+    """ Plan for extracting fields from an element in a single pass over its
+        descendants. The plan maps paths of tag names below the element,
+        like 'td/span/a', to handlers that are called with the dictionary of
+        extracted fields and every element at the path, in document order.
+        Only the elements that lead to one of the paths are visited.
+    """
+
+    def __init__(self, rules):
+        # Tree of (handlers, children) tuples, keyed by tag
+        self._tree = {}
+        for (path, handler) in rules:
+            node = (None, self._tree)
+            for tag in path.split('/'):
+                node = node[1].setdefault(tag, ([], {}))
+            node[0].append(handler)
+
+    def apply(self, element, fields):
+        """ Applies the plan to the given element, adding the extracted
+            fields to the given dictionary, which is returned.
+        """
+        self._walk(element, self._tree, fields)
+        return fields
+
+    def _walk(self, element, tree, fields):
+        for child in element:
+            node = tree.get(child.tag)
+            if node is None:
+                continue
+            for handler in node[0]:
+                handler(fields, child)
+            if node[1]:
+                self._walk(child, node[1], fields)
+
+
+def _extract_kg_id(fields, link):
+    if 'kg_id' not in fields:
+        fields['kg_id'] = int(KG_ID_REXP.match(link.get('href')).groups()[0])
+
+
+def _extract_title(fields, element):
+    fields.setdefault('title', element.text)
+
+
+def _extract_link(fields, link):
+    fields['links'].append(link)
+
+
+def _extract_country(fields, img):
+    fields.setdefault('country', img.get('alt'))
+
+
+def _extract_media_type(fields, img):
+    if img.get('width') == '40' and 'media_type' not in fields:
+        fields['media_type'] = img.get('title').split(':')[0]
+
+
+def _extract_details_cell(fields, cell):
+    cell_class = cell.get('class')
+    if cell_class == 'rowhead':
+        fields['rowhead'] = cell
+    elif cell_class == 'heading':
+        fields['heading'] = (cell.text or '').strip()
+    elif cell.get('align') == 'left':
+        fields.setdefault('value', cell)
+
+
+def _extract_imdb_id(cell):
+    for link in cell.iter('a'):
+        if link.get('target') != '_blank':
+            continue
+        imdb_url = link.get('href')
+        match = IMDB_ID_REXP.match(imdb_url)
+        if match:
+            _logger.debug("Found a valid imdb-link!")
+            return int(match.groups()[0])
+        else:
+            _logger.debug("\"%s\" doesn't seem to be an imdb-url!" % imdb_url)
+            return None
+
+
+def _extract_link_text(cell):
+    return next(cell.iter('a')).text
+
+
+def _extract_link_texts(cell):
+    return [x.text for x in cell.iter('a') if x.text]
+
+
+def _extract_text(cell):
+    if cell.text is None:
+        return None
+    return cell.text.strip()
+
+
+# Rows of the tables listing items on the browse, history and bookmarks pages
+RESULT_ROW_PLAN = ExtractionPlan([
+    ('td/span/a', _extract_kg_id),
+    ('td/span/a/b', _extract_title),
+    ('td/a', _extract_link),
+    ('td/a/img', _extract_country),
+    ('td/div/a/img', _extract_media_type)])
+
+# Rows of the table on the details page, the field is extracted from the value
+# cell according to the heading cell.
+DETAILS_ROW_PLAN = ExtractionPlan([('td', _extract_details_cell)])
+DETAILS_FIELDS = {
+    'Internet Link': ('imdb_id', _extract_imdb_id),
+    'Director / Artist': ('director',
+                          lambda cell: unicode(_extract_link_text(cell))),
+    'Year': ('year', _extract_link_text),
+    'Genres': ('genres', _extract_link_texts),
+    'Language': ('language', _extract_text),
+    # TODO: Get subtitles. How to handle included/external subs?
+    'Source': ('source', _extract_text)}
+
+
+def _parse_markup(markup):
+    """ Builds a XML element tree from the markup it gets passed, tidying
+        it beforehand if lxml is not available.
+    """
+    # Small fix for a cornercase involving invalid characters...
+    markup = markup.replace('\x15', '_')
+    if lxml:
+        return lxml.html.document_fromstring(markup)
+    clean_markup = tidy_document(markup,
+                                 options={'numeric-entities':1,
+                                          'output-xml':1,
+                                          'output-encoding':'utf8'})[0]
+    return _fix_treetags(ET.fromstring(clean_markup))
+
+
+def _fix_treetags(tree):
+    """ Removes the namespace prefix from all tags in a given XML element
+        tree to facilitate querying.
+    """
+    for element in tree:
+        element.tag = element.tag.split('}')[1]
+        if len(element.getchildren()) > 0:
+            _fix_treetags(element)
+    return tree
+
+
+def _get_max_pagenum(page_links):
+    """ Gets the last pagenumber that results are available for from the
+        links to the result pages, or None if there are no such links.
+    """
+    #Find the largest value for 'page'
+    page_nums = [int(PAGE_REXP.match(x).groups()[0]) for x in page_links
+                 if x and PAGE_REXP.match(x)]
+    # Results that fit on a single page come without any page links, but
+    # the links may also be missing because the page is laid out differently
+    return max(page_nums) if page_nums else None
+
+
+def _find_result_table(page):
+    """ Returns a tuple with the table listing KG items on a result page
+        and the number of the last page that results are available for, if
+        known.
+    """
+    table = list(page.findall(".//table[@id='browse']"))[0]
+    page_links = [x.get('href') for x in
+                  page.findall('body/table/tr/td//p/a')]
+    return (table, _get_max_pagenum(page_links))
+
+
+def _parse_result_rows(table):
+    """ Parses a table listing KG items. """
+    return [_parse_item_row(row) for row in list(table.findall('tr'))[1:]
+            if len(row.getchildren()) != 1]
+
+
+def _parse_item_row(row):
+    """ Parses a row from a table of results and returns a dictionary with
+        all relevant information on the item.
+    """
+    fields = RESULT_ROW_PLAN.apply(row, {'links': []})
+    item = KGItem(fields['kg_id'])
+    title_string = fields['title']
+    if " AKA " in title_string:
+        (item.orig_title, item.aka_title) = title_string.split(' AKA ')[0:2]
+    else:
+        item.orig_title = title_string
+    var_links = fields['links']
+    item.director = var_links[0].text
+    item.year = var_links[1].text
+    item.genres = [x.text for x in var_links
+                   if GENRE_REXP.match(x.get('href'))]
+    item.media_type = fields['media_type']
+    item.country = fields['country']
+    return item
+
+
+def _parse_details(page, kg_id):
+    """ Parses a page that contains details for a KG item.
+        Returns a tuple with the KGItem, still lacking its files, and the
+        name and the url of its torrent.
+        FIXME: A little too b
+    """
+    item = KGItem(int(kg_id))
+    title = page.find(".//title").text.strip()
+    title = H1_REXP.match(title).groups()[0]
+    if " aka " in title:
+        (item.orig_title, item.aka_title) = title.split(' aka ')[0:2]
+    elif " AKA " in title:
+        (item.orig_title, item.aka_title) = title.split(' AKA ')[0:2]
+    else:
+        item.orig_title = title
+    item.country = page.find(
+        ".//table[@class='main']/tr/td[@class='outer']/h1/img").get("alt")
+
+    table = list(page.findall(".//table[@width='750']"))[0]
+    for row in (x for x in list(table.findall('tr'))
+            if len(x.getchildren()) != 1):
+        cells = DETAILS_ROW_PLAN.apply(row, {})
+        if 'rowhead' in cells:
+            torrent_link = next(row.iter('a'))
+            torrent_name = torrent_link.text.strip()
+            torrent_url = torrent_link.get('href')
+        elif cells.get('heading') in DETAILS_FIELDS:
+            (attribute, extract) = DETAILS_FIELDS[cells['heading']]
+            setattr(item, attribute, extract(cells.get('value', row)))
+    return (item, torrent_name, torrent_url)
+
+
+# The following functions run in the processes of the parse pipeline, so they
+# take the raw markup and only return picklable values.
+
+def _parse_result_markup(markup):
+    """ Parses a result page. Returns a tuple with the list of items on it
+        and the number of the last page that results are available for, if
+        known.
+    """
+    (table, last_page) = _find_result_table(_parse_markup(markup))
+    return (_parse_result_rows(table), last_page)
+
+
+def _parse_details_markup(kg_id, markup):
+    """ Parses a details page, see `_parse_details`. """
+    return _parse_details(_parse_markup(markup), kg_id)
+
+
 class Pyragarga(object):
     """ Class that represents the tracker's API."""
     # TODO: Move all tracker-code to a separate TrackerApi class, so that
@@ -73,344 +425,1489 @@ class Pyragarga(object):
     #       Problems:  The whole API revolves around 'KGItem'-objects.
     #                  What would a more abstract type look like?
 
-    def __init__(self, username, password, db_file=None):
-        """ Initialize access to the tracker by logging in. """
+    def __init__(self, username, password, db_file=None, max_workers=4,
+                 stream_results=False, torrent_cache_dir=None,
+                 response_cache=None, timeout=30, retries=3, backoff=1.0,
+                 rate_limit=None, cookie_file=None, persist_session=False,
+                 url=KG_URL, instrument=False, stats_hook=None,
+                 parse_processes=None):
+        """ Initialize access to the tracker by logging in.
+            `max_workers` limits the number of pages that are fetched from
+            the tracker concurrently. With `stream_results`, only the
+            results table and the page links are extracted from result pages
+            while they are downloaded, instead of building a tree of the
+            whole page. If `torrent_cache_dir` is given, the file lists of
+            downloaded torrents are cached in it. Pages are looked up in
+            `response_cache`, e.g. a `ResponseCache`, before requesting them.
+            Requests time out after `timeout` seconds and are retried up to
+            `retries` times, waiting `backoff` seconds before the first retry
+            and twice as long before each further one. `rate_limit` limits
+            the number of requests per second across all threads.
+            The session's cookies are saved to `cookie_file`, or to the
+            database if `persist_session` is set, and are reused instead of
+            logging in again until the session expires. `url` is the base
+            url of the tracker. With `instrument`, timings and counters of
+            all stages are collected, see `stats`, and passed on to
+            `stats_hook` if given. With `parse_processes`, pages are parsed
+            by that many processes while the threads keep fetching, instead
+            of streaming them. The processes are started when first needed
+            and stopped by `close`, or at the end of a `with` block.
+        """
         self.logger = logging.getLogger('pyragarga.Pyragarga')
+        self.url = url
+        self._stats = NullStats()
+        if instrument or stats_hook:
+            self._stats = Stats()
+            if stats_hook:
+                self._stats.add_hook(stats_hook)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._rate_limiter = None
+        if rate_limit:
+            self._rate_limiter = RateLimiter(rate_limit, burst=max_workers)
+        self.stream_results = stream_results
+        self.parse_processes = parse_processes
+        self._parse_pool = None
+        self._parse_pool_lock = threading.Lock()
+        self._response_cache = response_cache
+        self._torrent_cache = None
+        if torrent_cache_dir:
+            self._torrent_cache = TorrentCache(torrent_cache_dir)
         self._database = None
         if db_file:
             self.enable_db(db_file)
+        self._username = username
+        self._password = password
+        self.cookie_file = cookie_file
+        self.persist_session = persist_session
+        self._login_lock = threading.Lock()
+        self._login_count = 0
         self._session = requests.session()
-        self._session.post(KG_URL + LOGIN_SCRIPT,
-                data={'username':username, 'password':password})
-        self.user_id = self._session.cookies['uid']
-        self.logger.info('Logged into KG as user %s' % username)
+        # Keep a connection open for every thread fetching pages
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        cookies = self._load_cookies()
+        if cookies and 'uid' in cookies:
+            self._session.cookies.update(cookies)
+            self.user_id = cookies['uid']
+            self.logger.info('Reusing session of KG user %s' % username)
+        else:
+            self._login()
 
-    def enable_db(self, db_file):
+    def enable_db(self, db_file, journal_mode=None, synchronous=None):
         if not self._database:
-            self._database = LocalDatabase(db_file)
+            self._database = LocalDatabase(db_file, journal_mode=journal_mode,
+                                           synchronous=synchronous)
     
+    def match_library(self, directory, search_unmatched=True):
+        """ Returns a dictionary mapping the paths of all media files in the
+            given directory to the items they belong to, see
+            `LibraryMatcher.scan`.
+        """
+        if not self._database:
+            raise PyragargaError("Matching a library requires a database.")
+        return LibraryMatcher(self._database, tracker=self).scan(
+            directory, search_unmatched=search_unmatched)
+
+    def close(self):
+        """ Stops the processes parsing pages and closes the connections to
+            the tracker. No operation may be running at the same time.
+        """
+        with self._parse_pool_lock:
+            (parse_pool, self._parse_pool) = (self._parse_pool, None)
+        if parse_pool:
+            parse_pool.terminate()
+            parse_pool.join()
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def stats(self):
+        """ Returns a snapshot of the timings and counters collected so far,
+            which is empty unless instrumentation is enabled.
+        """
+        return self._stats.snapshot()
+
     def get_item(self, item_id):
         """ Returns the item with the given id. """
         if self._database:
             try:
-                return self._database.retrieve(item_id)
+                with self._stats.timer('db.retrieve'):
+                    item = self._database.retrieve(item_id)
+                self._stats.incr('db.hits')
+                return item
             except PyragargaError:
-                pass
-        # TODO: Retry if it times out 
-        details_page = self._build_tree(
-                self._session.get(KG_URL + DETAILS_SCRIPT,
-                    params={'id': item_id, 'filelist':1}
-                    ).content)
-        item = self._parse_details_page(details_page, item_id)
+                self._stats.incr('db.misses')
+        item = self._fetch_item(item_id)
         if self._database:
-            self._database.store(item)
-        self.logger.info('Received details for item %d' % item.kg_id)
+            with self._stats.timer('db.store'):
+                self._database.store(item)
         return item
 
+    def get_items(self, item_ids):
+        """ Returns a list with the items with the given ids, in the same
+            order. Items not found in the local database are fetched from
+            the tracker concurrently and stored in a single transaction.
+        """
+        item_ids = [int(x) for x in item_ids]
+        items = {}
+        if self._database:
+            with self._stats.timer('db.retrieve'):
+                items.update(self._database.retrieve_many(item_ids))
+        missing, missing_ids = [], set()
+        for item_id in item_ids:
+            # Don't fetch an item twice if its id was passed more than once
+            if item_id not in items and item_id not in missing_ids:
+                missing.append(item_id)
+                missing_ids.add(item_id)
+        if self._database and len(item_ids) > len(missing):
+            self._stats.incr('db.hits', len(item_ids) - len(missing))
+        if self._database and missing:
+            self._stats.incr('db.misses', len(missing))
+        fetched = self._map_concurrently(self._fetch_item, missing)
+        if self._database and fetched:
+            with self._stats.timer('db.store'):
+                self._database.store_many(fetched)
+        items.update((x.kg_id, x) for x in fetched)
+        return [items[x] for x in item_ids]
+
     def search(self, query, search_type='torrent', num_pages=1,
             movies_only=True):
         """ Execute a search query for torrents of type `search_type` and
             present the results retreived from `num_pages`.
         """
-        result_pages = []
-        result_pages.append(self._do_search(query,
-            options={'search_type':search_type}))
-        if num_pages > 1:
-            page_num = 1
-            while page_num < (num_pages):
-                result_pages.append(self._do_search(query,
-                    options={'search_type':search_type, 'page':page_num}))
-                page_num += 1
-        result_items = []
-        for page in result_pages:
-            result_items += self._parse_result_page(page)
-        if movies_only:
-            result_items = [x for x in result_items
-                            if x.media_type == 'Movie']
-        return result_items
-    
+        return list(self.iter_search(query, search_type=search_type,
+                                     num_pages=num_pages,
+                                     movies_only=movies_only))
+
+    def iter_search(self, query, search_type='torrent', num_pages=1,
+            movies_only=True):
+        """ Like `search`, but yields the results page by page as they are
+            retrieved.
+        """
+        def get_page(page_num):
+            options = {'search_type':search_type}
+            if page_num > 0:
+                options['page'] = page_num
+            return self._do_search(query, options=options)
+        for items in self._iter_result_pages(get_page, num_pages=num_pages):
+            for item in self._filter_items(items, movies_only):
+                yield item
+
     def get_snatched(self, user_id=None, movies_only=True, grab_full=False):
         """ Returns a list with all items on the tracker snatched by the user.
         """
+        return list(self.iter_snatched(user_id=user_id,
+                                       movies_only=movies_only,
+                                       grab_full=grab_full))
+
+    def iter_snatched(self, user_id=None, movies_only=True, grab_full=False):
+        """ Like `get_snatched`, but yields the items page by page as they
+            are retrieved.
+        """
         if not user_id:
             user_id = self.user_id
-        current_page = 0
-        snatched_pages = []
-        snatched_pages.append(self._build_tree(
-                self._session.get(KG_URL + HISTORY_SCRIPT,
-                    params={'id': user_id, 'rcompsort':1, 'page':current_page}
-                    ).content))
-        current_page += 1
-        last_page = self._get_max_pagenum(snatched_pages[0])
-        while current_page <= last_page:
-            self.logger.debug('Getting page %d of %d of snatched torrents'
-                    % (current_page, last_page))
-            snatched_pages.append(self._build_tree(
-                self._session.get(KG_URL + HISTORY_SCRIPT,
-                params={'id':user_id, 'rcompsort':1, 'page':current_page}
-                ).content))
-            current_page += 1
-        snatched_items = []
-        self.logger.debug('Parsing "snatched torrents" pages')
-        for page in snatched_pages:
-            snatched_items += self._parse_result_page(page)
+        pages = self._iter_result_pages(
+            lambda page_num: self._get_history_page(user_id, page_num))
+        for items in pages:
+            for item in self._filter_items(items, movies_only, grab_full):
+                yield item
+
+    def sync_snatched(self, user_id=None, movies_only=True, grab_full=False):
+        """ Returns a list with the items snatched by the user since the last
+            sync, newest first. Pages of snatched torrents are only fetched
+            until the newest item of the last sync is found. The newest item
+            is recorded in the database once all items have been retrieved,
+            so that they are returned again if that fails.
+        """
+        if not self._database:
+            raise PyragargaError("Syncing requires a database.")
+        if not user_id:
+            user_id = self.user_id
+        last_synced = self._database.get_last_synced(user_id)
+        new_items = []
+        for items in self._iter_snatched_since(user_id, last_synced):
+            new_items += items
+        self.logger.info('Found %d newly snatched items' % len(new_items))
+        new_ids = [x.kg_id for x in new_items]
         if movies_only:
-            snatched_items = [x for x in snatched_items
-                              if x.media_type == 'Movie']
+            new_items = [x for x in new_items if x.media_type == 'Movie']
         if grab_full:
-            snatched_items = [self.get_item(x.kg_id) for x in snatched_items]
-        return snatched_items
+            new_items = self.get_items(x.kg_id for x in new_items)
+        if new_ids:
+            self._database.set_last_synced(user_id, new_ids[0],
+                                           snatched_ids=new_ids)
+        return new_items
 
-    def get_bookmarks(self, snatched=False):
+    def get_bookmarks(self, snatched=False, snatched_ids=None):
         """ Returns a list with all items bookmarked on the tracker by the
-            user, by default excluding any item already snatched.
-        """
-        # TODO: Implement this properly
-        #       Idea:
-        #           - Get first page of bookmarks
-        #           - Determine number of last page ('_get_max_pagenum')
-        #           - Go through all bookmarks pages, parsing them for
-        #             KGItems ('_parse_result_page')
-        #start_page = self._build_tree(
-        #    self._session.get(KG_URL + BOOKMARKS_SCRIPT,
-        #        params={'page':0}).content)
-        raise NotImplementedError
+            user, by default excluding any item already snatched, see
+            `iter_bookmarks`.
+        """
+        return list(self.iter_bookmarks(snatched=snatched,
+                                        snatched_ids=snatched_ids))
+
+    def iter_bookmarks(self, snatched=False, snatched_ids=None):
+        """ Like `get_bookmarks`, but yields the items page by page as they
+            are retrieved. Excluding the snatched items requires the ids of
+            all of them, which are taken from `snatched_ids` if given.
+            Otherwise they are retrieved before the first item is yielded:
+            if the user's snatched items were synced to the database, see
+            `sync_snatched`, only the ones snatched since are fetched,
+            else the whole history of snatched items, which may take many
+            requests.
+        """
+        if snatched:
+            snatched_ids = set()
+        elif snatched_ids is None:
+            snatched_ids = self._get_snatched_ids(self.user_id)
+        else:
+            snatched_ids = set(snatched_ids)
+        pages = self._iter_result_pages(
+            lambda page_num: self._get_result_items(BOOKMARKS_SCRIPT,
+                                                    params={'page':page_num}))
+        for items in pages:
+            for item in items:
+                if item.kg_id not in snatched_ids:
+                    yield item
+
+    def _get_snatched_ids(self, user_id):
+        """ Returns a set with the ids of all items snatched by the user,
+            only fetching the ones snatched since the last sync if the ids
+            of the others are in the database.
+        """
+        if self._database:
+            snatched_ids = self._database.get_snatched_ids(user_id)
+            if snatched_ids is not None:
+                last_synced = self._database.get_last_synced(user_id)
+                for items in self._iter_snatched_since(user_id, last_synced):
+                    snatched_ids.update(x.kg_id for x in items)
+                return snatched_ids
+        snatched_ids = set(x.kg_id for x in
+                           self.iter_snatched(user_id=user_id,
+                                              movies_only=False))
+        if self._database and self._database.get_last_synced(user_id):
+            # The user was synced before the ids were recorded
+            self._database.set_snatched_ids(user_id, snatched_ids)
+        return snatched_ids
+
+    def _iter_snatched_since(self, user_id, last_synced):
+        """ Yields lists with the items on consecutive pages of the user's
+            snatched torrents, newest first, until the item with the id
+            `last_synced` is found.
+        """
+        page_num = last_page = 0
+        while page_num <= last_page:
+            self.logger.debug('Getting page %d of snatched torrents'
+                    % page_num)
+            (items, last_page) = self._get_history_page(user_id, page_num)
+            last_page = last_page or 0
+            kg_ids = [x.kg_id for x in items]
+            if last_synced in kg_ids:
+                yield items[:kg_ids.index(last_synced)]
+                return
+            yield items
+            page_num += 1
+
+    def _iter_result_pages(self, get_page, num_pages=None):
+        """ Yields lists with the items on consecutive result pages, using
+            `get_page` to fetch and parse a page by its number. After the
+            first page the number of pages is usually known from its page
+            links, and the remaining ones, up to `num_pages` if given, are
+            fetched concurrently.
+        """
+        (items, last_page) = get_page(0)
+        yield items
+        if last_page is None:
+            # Without any page links the number of pages is unknown, so
+            # the requested ones are fetched regardless
+            last_page = 0 if num_pages is None else num_pages - 1
+        elif num_pages is not None:
+            last_page = min(last_page, num_pages - 1)
+        self.logger.debug('Getting %d more result pages' % last_page)
+        for (items, _) in self._imap_concurrently(get_page,
+                                                  range(1, last_page + 1)):
+            yield items
+
+    def _filter_items(self, items, movies_only, grab_full=False):
+        """ Helper method that leaves out all items but movies if requested
+            and replaces the items with their full details if requested.
+        """
+        if movies_only:
+            items = [x for x in items if x.media_type == 'Movie']
+        if grab_full:
+            items = self.get_items(x.kg_id for x in items)
+        return items
+
+    def _fetch_item(self, item_id):
+        """ Fetches the details of the item with the given id from the
+            tracker.
+        """
+        markup = self._get(self.url + DETAILS_SCRIPT,
+                           params={'id': item_id, 'filelist':1}).content
+        parse_pool = self._get_parse_pool()
+        if parse_pool:
+            with self._stats.timer('parse.pipeline'):
+                details = parse_pool.apply(_parse_details_markup,
+                                           (item_id, markup))
+            # The torrent is downloaded by this thread, not the pipeline
+            item = self._add_files(*details)
+        else:
+            item = self._parse_details_page(self._build_tree(markup), item_id)
+        self.logger.info('Received details for item %d' % item.kg_id)
+        return item
+
+    def _get_parse_pool(self):
+        """ Returns the pool of processes that parse pages, starting it
+            when first needed, or None if pages are parsed in this process.
+        """
+        if not self.parse_processes:
+            return None
+        with self._parse_pool_lock:
+            if not self._parse_pool:
+                self._parse_pool = multiprocessing.Pool(self.parse_processes)
+            return self._parse_pool
+
+    def _map_concurrently(self, func, args):
+        """ Helper method that applies `func` to every element of `args`,
+            using up to `max_workers` threads. The results are returned in
+            the same order as `args`.
+        """
+        return list(self._imap_concurrently(func, args))
+
+    def _imap_concurrently(self, func, args):
+        """ Like `_map_concurrently`, but yields the results in order as they
+            become available. No more than `max_workers` results are
+            computed ahead of the ones already consumed.
+        """
+        args = list(args)
+        if self.max_workers < 2 or len(args) < 2:
+            for arg in args:
+                yield func(arg)
+            return
+        # Start the processes parsing pages first, so that they aren't forked
+        # from one of the threads
+        self._get_parse_pool()
+        pool = ThreadPool(min(self.max_workers, len(args)))
+        pending = collections.deque()
+        try:
+            for arg in args:
+                pending.append(pool.apply_async(func, (arg,)))
+                if len(pending) >= self.max_workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            # Also stops the remaining calls if the consumer stopped early
+            pool.terminate()
+            pool.join()
+
+    def _get_history_page(self, user_id, page_num):
+        """ Fetches and parses the given page of a user's snatched
+            torrents, see `_get_result_items`.
+        """
+        return self._get_result_items(HISTORY_SCRIPT,
+                params={'id':user_id, 'rcompsort':1, 'page':page_num})
+
+    def _get_result_items(self, script, params):
+        """ Fetches and parses a page that contains a table listing KG
+            items. Returns a tuple with the list of items and the number of
+            the last page that results are available for, if known.
+        """
+        parse_pool = self._get_parse_pool()
+        if parse_pool:
+            markup = self._get(self.url + script, params=params).content
+            # Waiting for the result releases the GIL, so that the other
+            # threads can go on fetching pages meanwhile
+            with self._stats.timer('parse.pipeline'):
+                return parse_pool.apply(_parse_result_markup, (markup,))
+        (table, last_page) = self._get_result_page(script, params)
+        return (self._parse_result_table(table), last_page)
+
+    def _get_result_page(self, script, params):
+        """ Fetches a page that contains a table listing KG items.
+            Returns a tuple with the table and the number of the last page
+            that results are available for, if known.
+        """
+        response = self._get(self.url + script, params=params,
+                             stream=self.stream_results)
+        if not self.stream_results:
+            return _find_result_table(self._build_tree(response.content))
+        extractor = ResultTableExtractor()
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE,
+                                           decode_unicode=True):
+            with self._stats.timer('parse.stream_extract'):
+                extractor.feed(chunk)
+        extractor.close()
+        if extractor.table is None:
+            raise PyragargaError("No results table found.")
+        return (extractor.table, _get_max_pagenum(extractor.page_links))
+
+    def _get(self, url, params=None, stream=False):
+        """ Sends a GET request through the session, answering it from the
+            response cache if possible.
+        """
+        if not self._response_cache:
+            return self._request(url, params=params, stream=stream)
+        # Sort the parameters, so that every page has exactly one url
+        url = requests.Request('GET', url,
+                               params=sorted((params or {}).items())
+                               ).prepare().url
+        cached = self._response_cache.lookup(url)
+        headers = {}
+        if not cached:
+            self._stats.incr('response_cache.misses')
+        else:
+            if cached.fresh:
+                self._stats.incr('response_cache.hits')
+                return cached.to_response()
+            self._stats.incr('response_cache.stale')
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        response = self._request(url, headers=headers)
+        if response.status_code == 304 and cached:
+            self.logger.debug('Revalidated cached response for %s' % url)
+            self._response_cache.refresh(url)
+            return cached.to_response()
+        if response.status_code == 200:
+            self._response_cache.store(url, response)
+        return response
+
+    def _login(self):
+        """ Logs into the tracker and saves the session's cookies. """
+        self._session.cookies.clear()
+        self._session.post(self.url + LOGIN_SCRIPT,
+                data={'username':self._username, 'password':self._password},
+                timeout=self.timeout)
+        self.user_id = self._session.cookies['uid']
+        self._login_count += 1
+        self._save_cookies(
+            requests.utils.dict_from_cookiejar(self._session.cookies))
+        self.logger.info('Logged into KG as user %s' % self._username)
+
+    def _load_cookies(self):
+        """ Returns a dictionary with the saved cookies, if any. """
+        if self.cookie_file:
+            try:
+                with open(self.cookie_file, 'rb') as cookie_file:
+                    return json.load(cookie_file)
+            except (IOError, ValueError):
+                return None
+        if self.persist_session and self._database:
+            return self._database.load_cookies()
+        return None
+
+    def _save_cookies(self, cookies):
+        """ Saves the given dictionary of cookies. """
+        if self.cookie_file:
+            # The cookies give access to the account, so only the current
+            # user may read them
+            fd = os.open(self.cookie_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as cookie_file:
+                json.dump(cookies, cookie_file)
+        elif self.persist_session and self._database:
+            self._database.save_cookies(cookies)
+
+    def _request(self, url, params=None, stream=False, headers=None):
+        """ Sends a GET request through the session, logging in again if
+            the response shows that the session has expired.
+        """
+        login_count = self._login_count
+        response = self._send(url, params=params, stream=stream,
+                              headers=headers)
+        if urlparse.urlparse(response.url or '').path.endswith(
+                '/' + LOGIN_PAGE):
+            with self._login_lock:
+                # Another thread may have logged in again in the meantime
+                if self._login_count == login_count:
+                    self.logger.info('Session expired, logging in again')
+                    self._login()
+            response = self._send(url, params=params, stream=stream,
+                                  headers=headers)
+        return response
+
+    def _send(self, url, params=None, stream=False, headers=None):
+        """ Sends a GET request through the session, retrying it with
+            exponential backoff if it times out, the connection fails or the
+            server is unable to handle it.
+        """
+        for attempt in range(self.retries + 1):
+            if self._rate_limiter:
+                self._rate_limiter.acquire()
+            delay = self.backoff * 2**attempt
+            try:
+                with self._stats.timer('http.fetch'):
+                    response = self._session.get(url, params=params,
+                                                 stream=stream,
+                                                 headers=headers,
+                                                 timeout=self.timeout)
+            except (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError) as e:
+                self._stats.incr('http.errors')
+                if attempt == self.retries:
+                    raise
+                self.logger.warning('Request for %s failed (%s), retrying in '
+                                    '%.1f seconds' % (url, e, delay))
+            else:
+                self._stats.incr('http.requests')
+                self._stats.incr('http.bytes', int(
+                    response.headers.get('Content-Length') or
+                    (0 if stream else len(response.content))))
+                if (response.status_code not in RETRY_STATUS_CODES
+                        or attempt == self.retries):
+                    return response
+                self._stats.incr('http.errors')
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                self.logger.warning('Request for %s got status %d, retrying '
+                                    'in %.1f seconds'
+                                    % (url, response.status_code, delay))
+                response.close()
+            self._stats.incr('http.retries')
+            time.sleep(delay)
 
     def _build_tree(self, markup):
         """ Helper method that builds a XML element tree from the markup
-            it gets passed, tidying it beforehand.
-        """
-        clean_markup = tidy_document(markup,
-                                     options={'numeric-entities':1,
-                                              'output-xml':1,
-                                              'output-encoding':'utf8'})[0]
-        # Small fix for a cornercase involving invalid characters...
-        clean_markup = clean_markup.replace('\x15', '_')
-        etree = self._fix_treetags(ET.fromstring(clean_markup))
-        return etree
-
-    def _fix_treetags(self, tree):
-        """ Helper method that removes the namespace prefix from all tags
-            in a given XML element tree to facilitate querying.
-        """
-        for element in tree:
-            element.tag = element.tag.split('}')[1]
-            if len(element.getchildren()) > 0:
-                self._fix_treetags(element)
-        return tree
-            
-    def _get_max_pagenum(self, pagetree):
-        """ Gets the last pagenumber that results are available for. """
-        browse_links = [x.get('href') for x in
-                      pagetree.findall('body/table/tr/td//p/a')]
-        #Find the largest value for 'page'
-        page_nums = [int(PAGE_REXP.match(x).groups()[0]) for x in browse_links]
-        page_nums.sort(reverse=True)
-        max_pagenum = page_nums[0]
-        return max_pagenum
+            it gets passed, tidying it beforehand if lxml is not available.
+        """
+        with self._stats.timer('parse.build_tree'):
+            return _parse_markup(markup)
 
     def _do_search(self, query, options=None):
         default_options = {'incldead':0}
         options.update(default_options)
         # Add the search query
         options.update({'search':query})
-        result_tree = self._build_tree(
-                self._session.get(KG_URL + BROWSE_SCRIPT,
-                    params=options).content
-                )
-        return result_tree
+        return self._get_result_items(BROWSE_SCRIPT, params=options)
 
     def _parse_details_page(self, page, kg_id):
         """ Parses a page that contains details for a KG item.
             Returns a KGItem.
-            FIXME: A little too b
-        """
-        item = KGItem(int(kg_id))
-        title = page.find(".//title").text.strip()
-        title = H1_REXP.match(title).groups()[0]
-        if " aka " in title:
-            (item.orig_title, item.aka_title) = title.split(' aka ')[0:2]
-        elif " AKA " in title:
-            (item.orig_title, item.aka_title) = title.split(' AKA ')[0:2]
-        else:
-            item.orig_title = title
-        item.country = page.find(
-            ".//table[@class='main']/tr/td[@class='outer']/h1/img").get("alt")
-
-        table = list(page.findall(".//table[@width='750']"))[0]
-        for row in (x for x in list(table.findall('tr'))
-                if len(x.getchildren()) != 1):
-            rowhead = row.find(".//td[@class='rowhead']")
-            # For some reason 'bool(rowhead)' evaluates to 'False' even if
-            # it is not 'None'... Don't ask me why :-/
-            if rowhead != None:
-                torrent_link = row.findall(".//a")[0]
-                torrent_name = torrent_link.text.strip()
-                torrent_url = torrent_link.get('href')
-            else:
-                heading = row.find(".//td[@class='heading']").text.strip()
-                if heading == 'Internet Link':
-                    item.imdb_id = self._get_imdb_id(row)
-                elif heading == 'Director / Artist':
-                    item.director = unicode(row.find(".//a").text)
-                elif heading == 'Year':
-                    item.year = row.find(".//a").text
-                elif heading == 'Genres':
-                    item.genres = [x.text for x in row.findall(".//a")
-                                   if x.text]
-                elif heading == 'Language':
-                    item.language = row.find(
-                            ".//td[@align='left']").text.strip()
-                elif heading == 'Subtitles':
-                    # TODO: Get subtitles. How to handle included/external subs?
-                    pass
-                elif heading == 'Source':
-                    try:
-                        item.source = row.find(".//td[@align='left']"
-                                ).text.strip()
-                    except AttributeError:
-                        item.source = None
+        """
+        # Getting the files may involve downloading the torrent, which is
+        # recorded separately
+        with self._stats.timer('parse.details_page'):
+            details = _parse_details(page, kg_id)
+        return self._add_files(*details)
 
+    def _add_files(self, item, torrent_name, torrent_url):
+        """ Sets the files of the item to the file named by its torrent, or
+            to the ones contained in the torrent if it doesn't name one.
+            Returns the item.
+        """
         if FILENAME_REXP.match(torrent_name):
             item.files = [unicode(
                 FILENAME_REXP.match(torrent_name).groups()[0])]
         else:
-            torrent = self._session.get(KG_URL + torrent_url).content
-            item.files = self._get_files_from_torrent(torrent)
-
+            item.files = self._get_torrent_files(self.url + torrent_url)
         return item
 
+    def _parse_result_table(self, table):
+        """ Parses a table listing KG items. """
+        with self._stats.timer('parse.result_table'):
+            return _parse_result_rows(table)
 
-    def _parse_result_page(self, page):
-        """ Parses a page that contains a table listing KG items. """
-        items = []
-        table = list(page.findall(".//table[@id='browse']"))[0]
-        for row in (x for x in list(table.findall('tr'))[1:]
-                    if len(x.getchildren()) != 1):
-            item = self._parse_item_row(row)
-            items.append(item)
-        return items
-
-    def _parse_item_row(self, row):
-        """ Parses a row from a table of results and returns a dictionary with
-            all relevant information on the item.
+    def _get_torrent_files(self, torrent_url):
+        """ Returns a list with all the files contained in the torrent at
+            the given url, only downloading it if its file list is not
+            cached.
         """
-        item = KGItem(int(KG_ID_REXP.match(
-            row.find('td/span/a').get('href')).groups()[0]))
-        #item.imdb_id = self._get_imdb_id(row)
-        title_string = row.find('td/span/a/b').text
-        if " AKA " in title_string:
-            (item.orig_title, item.aka_title) = title_string.split(' AKA ')[0:2]
-        else:
-            item.orig_title = title_string
-        var_links = list(row.findall('td/a'))
-        item.director = var_links[0].text
-        item.year = var_links[1].text
-        item.genres = [x.text for x in var_links
-                       if GENRE_REXP.match(x.get('href'))]
-        item.media_type = row.find("td/div/a/img[@width='40']").get(
-                'title').split(':')[0]
-        item.country = row.find('td/a/img').get('alt')
-        return item
-
-    def _get_imdb_id(self, row):
-        imdb_link = row.find(".//a[@target='_blank']")
-        if imdb_link != None:
-            imdb_url = imdb_link.get('href')
-            match = IMDB_ID_REXP.match(imdb_url)
-            if match:
-                self.logger.debug("Found a valid imdb-link!")
-                return int(match.groups()[0])
-            else:
-                self.logger.debug("\"%s\" doesn't seem to be an imdb-url!" % imdb_url)
-                return None
+        if self._torrent_cache:
+            files = self._torrent_cache.get(torrent_url)
+            if files is not None:
+                self._stats.incr('torrent_cache.hits')
+                return files
+            self._stats.incr('torrent_cache.misses')
+        torrent = self._request(torrent_url).content
+        with self._stats.timer('torrent.decode'):
+            files = self._get_files_from_torrent(torrent)
+        if self._torrent_cache:
+            self._torrent_cache.put(torrent_url, files)
+        return files
 
     def _get_files_from_torrent(self, torrent):
         """ Returns a list with all the files contained in a given torrent. """
-        files = []
-        torrent_data = bdecode(torrent)
+        (name, paths) = _bdecode_file_list(torrent)
+        name = self._decode_torrent_string(name)
+        files = [name]
+        for path in paths:
+            files.append(os.path.join(name,
+                *[self._decode_torrent_string(x) for x in path]))
+        return files
+
+    def _decode_torrent_string(self, string):
         try:
-            name = unicode(torrent_data['info']['name'].decode('utf8'))
+            return unicode(string.decode('utf8'))
         except UnicodeDecodeError:
-            name = unicode(torrent_data['info']['name'].decode('iso8859-15'))
-        files.append(name)
-        if 'files' in torrent_data['info'].keys():
-            for file_ in [x['path']
-                          for x in torrent_data['info']['files']]:
-                # FIXME: Sometimes bdecode seems to give a list of length 1
-                #        instead of a plain string for 'path'
-                if type(file_) == list:
-                    try:
-                        file_ = unicode(file_[0].decode('utf8'))
-                    except UnicodeDecodeError:
-                        file_ = unicode(file_[0].decode('iso8859-15'))
-                files.append(os.path.join(name, file_))
-        return files
+            return unicode(string.decode('iso8859-15'))
 
 
-class LocalDatabase(object):
-    """ Manages items stored locally, to ease load on the KG-Server and make
-        querying faster.
+def _bdecode_file_list(torrent):
+    """ Decodes only the name and the paths of the files from the info
+        dictionary of a bencoded torrent, skipping everything else (most
+        notably the huge 'pieces' string) without decoding it.
+        Returns a tuple with the name and a list of paths, each of which is
+        a list of path components.
+    """
+    name = None
+    paths = []
+    for (key, info_pos) in _biter_dict(torrent, 0):
+        if key != 'info':
+            continue
+        for (info_key, pos) in _biter_dict(torrent, info_pos):
+            if info_key == 'name':
+                name = _bdecode_string(torrent, pos)
+            elif info_key == 'files':
+                for file_pos in _biter_list(torrent, pos):
+                    for (file_key, path_pos) in _biter_dict(torrent,
+                                                            file_pos):
+                        if file_key != 'path':
+                            continue
+                        # Some torrents contain a plain string instead of
+                        # a list of path components
+                        if torrent[path_pos] == 'l':
+                            paths.append([_bdecode_string(torrent, x) for x
+                                          in _biter_list(torrent, path_pos)])
+                        else:
+                            paths.append([_bdecode_string(torrent, path_pos)])
+        break
+    if name is None:
+        raise PyragargaError("Torrent has no name.")
+    return (name, paths)
+
+
+def _bdecode_string(data, pos):
+    """ Decodes the bencoded string at `pos`. """
+    colon = data.index(':', pos)
+    start = colon + 1
+    return data[start:start + int(data[pos:colon])]
+
+
+def _bskip(data, pos):
+    """ Returns the position right after the bencoded value at `pos`. """
+    char = data[pos]
+    if char == 'i':
+        return data.index('e', pos) + 1
+    elif char in 'ld':
+        pos += 1
+        while data[pos] != 'e':
+            pos = _bskip(data, pos)
+        return pos + 1
+    else:
+        colon = data.index(':', pos)
+        return colon + 1 + int(data[pos:colon])
+
+
+def _biter_list(data, pos):
+    """ Yields the positions of the values in the bencoded list at `pos`.
+    """
+    pos += 1
+    while data[pos] != 'e':
+        yield pos
+        pos = _bskip(data, pos)
+
+
+def _biter_dict(data, pos):
+    """ Yields tuples with the keys of the bencoded dictionary at `pos` and
+        the positions of their values.
+    """
+    pos += 1
+    while data[pos] != 'e':
+        key = _bdecode_string(data, pos)
+        pos = _bskip(data, pos)
+        yield (key, pos)
+        pos = _bskip(data, pos)
+
+
+class Stats(object):
+    """ Collects counters and latency histograms of the stages of
+        retrieving items. Every recorded value is also passed on to the
+        hooks, as `hook(kind, name, value)` with `kind` being either
+        'counter' or 'timing'. It can be shared by any number of threads.
+    """
+
+    # Upper bounds of the buckets of the latency histograms in seconds
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._hooks = []
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def incr(self, name, value=1):
+        """ Increases the counter with the given name. """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        for hook in self._hooks:
+            hook('counter', name, value)
+
+    def record(self, name, seconds):
+        """ Records a duration of the stage with the given name. """
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = {
+                    'count': 0, 'total': 0.0, 'max': 0.0,
+                    'histogram': [0]*len(Stats.buckets)}
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['histogram'][bisect.bisect_left(Stats.buckets,
+                                                   seconds)] += 1
+        for hook in self._hooks:
+            hook('timing', name, seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """ Context manager that records the duration of its block. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def snapshot(self):
+        """ Returns a dictionary with copies of all counters and timings,
+            including the hit rates of the caches.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {}
+            for (name, timing) in self._timings.items():
+                timings[name] = {
+                    'count': timing['count'],
+                    'total': timing['total'],
+                    'mean': timing['total'] / timing['count'],
+                    'max': timing['max'],
+                    'histogram': zip(Stats.buckets, timing['histogram'])}
+        hit_rates = {}
+        for name in counters:
+            if name.endswith('.hits'):
+                cache = name[:-len('.hits')]
+                lookups = sum(counters.get(cache + x, 0)
+                              for x in ('.hits', '.misses', '.stale'))
+                if lookups:
+                    hit_rates[cache] = float(counters[name]) / lookups
+        return {'counters': counters, 'timings': timings,
+                'hit_rates': hit_rates}
+
+
+class NullStats(object):
+    """ Stands in for `Stats` when instrumentation is disabled. """
+
+    def add_hook(self, hook):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+    def record(self, name, seconds):
+        pass
+
+    def timer(self, name):
+        return _null_timer
+
+    def snapshot(self):
+        return {'counters': {}, 'timings': {}, 'hit_rates': {}}
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class RateLimiter(object):
+    """ Token bucket that limits the rate of requests to `rate` per second,
+        allowing bursts of up to `burst` requests. It can be shared by any
+        number of threads.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a request may be sent. """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class TorrentCache(object):
+    """ Caches the file lists of torrents on disk, so that torrents only have
+        to be downloaded and decoded once.
+    """
+
+    def __init__(self, directory):
+        self.logger = logging.getLogger('pyragarga.TorrentCache')
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """ Returns the cached file list for the given key, e.g. the url of
+            a torrent, or None if it is not cached.
+        """
+        try:
+            with open(self._get_path(key), 'rb') as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, key, files):
+        """ Caches the given file list under the given key. """
+        path = self._get_path(key)
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partially written file list
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        with open(tmp_path, 'wb') as cache_file:
+            json.dump(files, cache_file)
+        os.rename(tmp_path, path)
+        self.logger.debug("Cached %d files for %s" % (len(files), key))
+
+    def _get_path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + '.json')
+
+
+class ResultTableExtractor(HTMLParser):
+    """ Incremental parser for pages that contain a table listing KG items.
+        Markup can be fed to it as it arrives, and only the results table
+        and the links to other result pages are kept.
+    """
+
+    # Elements that never have any content or an end tag
+    void_tags = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                           'input', 'link', 'meta', 'param', 'source', 'wbr'])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.table = None
+        self.page_links = []
+        self._stack = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict((key, value or '') for (key, value) in attrs)
+        if not self._stack:
+            if tag == 'table' and attrs.get('id') == 'browse':
+                self.table = ET.Element(tag, attrs)
+                self._stack.append(self.table)
+            elif tag == 'a' and PAGE_REXP.match(attrs.get('href', '')):
+                self.page_links.append(attrs['href'])
+            return
+        # Close the cells and rows whose end tags were omitted
+        if tag in ('td', 'th', 'tr'):
+            stop_tags = ('tr', 'table') if tag != 'tr' else ('table',)
+            while (self._stack[-1].tag not in stop_tags
+                   and len(self._stack) > 1):
+                self._stack.pop()
+        element = ET.SubElement(self._stack[-1], tag, attrs)
+        if tag not in ResultTableExtractor.void_tags:
+            self._stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if (self._stack and self._stack[-1].tag == tag
+                and tag not in ResultTableExtractor.void_tags):
+            self._stack.pop()
+
+    def handle_endtag(self, tag):
+        tags = [x.tag for x in self._stack]
+        if tag not in tags:
+            return
+        # Also close all elements whose end tags were omitted
+        del self._stack[len(tags) - tags[::-1].index(tag) - 1:]
+
+    def handle_data(self, data):
+        if not self._stack:
+            return
+        parent = self._stack[-1]
+        if len(parent):
+            parent[-1].tail = (parent[-1].tail or '') + data
+        else:
+            parent.text = (parent.text or '') + data
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+
+class CachedResponse(object):
+    """ A response stored in a `ResponseCache`. """
+
+    def __init__(self, url, content, encoding, etag, last_modified, fresh):
+        self.url = url
+        self.content = content
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh = fresh
+
+    def to_response(self):
+        """ Returns a `requests.Response` with the cached content. """
+        response = requests.models.Response()
+        response.url = self.url
+        response.status_code = 200
+        response.encoding = self.encoding
+        response._content = self.content
+        response._content_consumed = True
+        return response
+
+
+class ResponseCache(object):
+    """ Caches responses from the tracker in an SQLite database, evicting
+        the least recently used ones once the cache grows beyond `max_size`
+        bytes. How long a response stays fresh depends on the script that
+        sent it, stale responses are revalidated with the server.
     """
 
     schema = """
-                create table items (
-                    kg_id       integer primary key,
-                    imdb_id     integer,
-                    orig_title  text,
-                    aka_title   text,
-                    director    text,
-                    year        text,
-                    country     text,
-                    torrent     blob,
-                    genres      text,
-                    source      text,
-                    subtitles   text,
-                    language    text,
-                    media_type  text
+                create table if not exists responses (
+                    url             text primary key,
+                    content         blob,
+                    encoding        text,
+                    etag            text,
+                    last_modified   text,
+                    size            integer,
+                    fetched         real,
+                    accessed        real
                 );
 
-                create table files (
-                    id          integer primary key,
-                    filename    text,
-                    item_id     integer not null references items(kg_id)
-                );
+                create index if not exists responses_accessed
+                    on responses(accessed);
             """
 
-    def __init__(self, db_file):
+    # Number of seconds responses from the individual scripts stay fresh
+    default_ttls = {DETAILS_SCRIPT:7*24*60*60,
+                    BROWSE_SCRIPT:5*60,
+                    HISTORY_SCRIPT:5*60,
+                    BOOKMARKS_SCRIPT:5*60}
+
+    def __init__(self, db_file, ttls=None, default_ttl=0,
+                 max_size=256*1024*1024):
+        self.logger = logging.getLogger('pyragarga.ResponseCache')
+        self.ttls = dict(ResponseCache.default_ttls)
+        self.ttls.update(ttls or {})
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        # The cache is shared by all threads fetching pages
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.executescript(ResponseCache.schema)
+
+    def lookup(self, url):
+        """ Returns the `CachedResponse` for the given url, or None if it
+            is not cached.
+        """
+        with self._lock:
+            result = self.conn.execute("""select content, encoding, etag,
+                last_modified, fetched from responses where url = ?;""",
+                (url,)).fetchone()
+            if not result:
+                return None
+            now = time.time()
+            with self.conn:
+                self.conn.execute("""update responses set accessed = ?
+                    where url = ?;""", (now, url))
+        (content, encoding, etag, last_modified, fetched) = result
+        fresh = now - fetched < self._get_ttl(url)
+        return CachedResponse(url, str(content), encoding, etag,
+                              last_modified, fresh)
+
+    def store(self, url, response):
+        """ Stores the given `requests.Response` for the given url. """
+        now = time.time()
+        with self._lock:
+            with self.conn:
+                self.conn.execute("""insert or replace into responses
+                    (url, content, encoding, etag, last_modified, size,
+                     fetched, accessed) values (?, ?, ?, ?, ?, ?, ?, ?);""",
+                    (url, buffer(response.content), response.encoding,
+                     response.headers.get('ETag'),
+                     response.headers.get('Last-Modified'),
+                     len(response.content), now, now))
+                self._evict()
+
+    def refresh(self, url):
+        """ Marks the cached response for the given url as fresh again, e.g.
+            after the server confirmed that it has not been modified.
+        """
+        now = time.time()
+        with self._lock:
+            with self.conn:
+                self.conn.execute("""update responses set fetched = ?,
+                    accessed = ? where url = ?;""", (now, now, url))
+
+    def _get_ttl(self, url):
+        script = urlparse.urlparse(url).path.split('/')[-1]
+        return self.ttls.get(script, self.default_ttl)
+
+    def _evict(self):
+        """ Removes the least recently used responses until the cache is no
+            larger than `max_size`.
+        """
+        excess = self.conn.execute("""select total(size) from responses;"""
+                                   ).fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for (url, size) in self.conn.execute("""select url, size
+                from responses order by accessed;"""):
+            if excess <= 0:
+                break
+            evicted.append((url,))
+            excess -= size
+        self.conn.executemany("""delete from responses where url = ?;""",
+                              evicted)
+        self.logger.debug("Evicted %d responses" % len(evicted))
+
+
+class LibraryMatcher(object):
+    """ Matches the files of a local media library to the items in a
+        `LocalDatabase`, using an in-memory index of all stored files that
+        is built once. Files that are not in the database can be looked up
+        on the tracker.
+    """
+
+    def __init__(self, database, tracker=None):
+        self.logger = logging.getLogger('pyragarga.LibraryMatcher')
+        self.database = database
+        self.tracker = tracker
+        # Maps the basenames of all files to tuples of their paths inside
+        # the torrents and the ids of the items they belong to
+        self._index = {}
+        for (item_id, filename) in database.iter_files():
+            filename = os.path.normpath(filename)
+            self._index.setdefault(os.path.basename(filename), []).append(
+                (filename, item_id))
+        self.logger.info("Indexed %d file names" % len(self._index))
+
+    def match(self, path):
+        """ Returns the id of the item the file at the given path belongs
+            to, or None if it is not in the database.
+        """
+        # The stored file names are unicode, which paths in bytes don't equal
+        # unless they are ASCII
+        path = os.path.normpath(_decode_path(path))
+        for (filename, item_id) in self._index.get(os.path.basename(path), ()):
+            # Files in subdirectories of a torrent must be in the same
+            # subdirectories on disk
+            if path == filename or path.endswith(os.sep + filename):
+                return item_id
+        return None
+
+    def scan(self, directory, extensions=MEDIA_EXTENSIONS,
+             search_unmatched=True):
+        """ Returns a dictionary mapping the paths of all files in the given
+            directory with one of the given extensions to the items they
+            belong to. If `search_unmatched` is set and the matcher has a
+            tracker, the names of the torrents the remaining files probably
+            belong to are searched for on the tracker, once per name.
+            Items found that way only have the details listed in search
+            results. Files that could not be matched map to None.
+        """
+        extensions = tuple(x.lower() for x in extensions)
+        matches = {}
+        for (dirpath, dirnames, filenames) in os.walk(directory):
+            for filename in filenames:
+                if filename.lower().endswith(extensions):
+                    path = os.path.join(dirpath, filename)
+                    matches[path] = self.match(path)
+        items = self.database.retrieve_many(
+            x for x in matches.values() if x is not None)
+        unmatched = [x for x in matches if matches[x] is None]
+        self.logger.info("Matched %d of %d files in the database"
+                         % (len(matches) - len(unmatched), len(matches)))
+        result = dict((path, items.get(item_id))
+                      for (path, item_id) in matches.items())
+        if unmatched and search_unmatched and self.tracker:
+            result.update(self._search_unmatched(unmatched))
+        return result
+
+    def _search_unmatched(self, paths):
+        """ Searches the tracker for the torrents the given paths probably
+            belong to, returning a dictionary mapping the paths to the first
+            result of the searches.
+        """
+        names = {}
+        for path in paths:
+            names.setdefault(self._get_torrent_name(path), []).append(path)
+        results = self.tracker._map_concurrently(
+            lambda name: self.tracker.search(name, movies_only=False),
+            names.keys())
+        found = {}
+        for (name, result) in zip(names.keys(), results):
+            for path in names[name]:
+                found[path] = result[0] if result else None
+        return found
+
+    def _get_torrent_name(self, path):
+        """ Returns the name of the torrent that the file at the given path
+            probably belongs to. This is the file's name unless it is part of
+            a disc structure, where the name of the disc's directory is used.
+        """
+        path = os.path.normpath(_decode_path(path))
+        (parent, filename) = os.path.split(path)
+        if os.path.basename(parent).upper() in DISC_DIRECTORIES:
+            return os.path.basename(os.path.dirname(parent))
+        return filename
+
+
+def _decode_path(path):
+    """ Returns the given path as unicode, decoding it with the encoding of
+        the file system, or else like the strings in torrents.
+    """
+    if isinstance(path, unicode):
+        return path
+    try:
+        return path.decode(sys.getfilesystemencoding() or 'utf8')
+    except (UnicodeDecodeError, LookupError):
+        pass
+    try:
+        return path.decode('utf8')
+    except UnicodeDecodeError:
+        return path.decode('iso8859-15')
+
+
+class LocalDatabase(object):
+    """ Manages items stored locally, to ease load on the KG-Server and make
+        querying faster.
+    """
+
+    # Version of the schema, databases with an older version are migrated
+    # by running all '_migrate_to_<version>' methods up to this one.
+    # The version of a database is kept in SQLite's 'user_version'.
+    schema_version = 6
+
+    # Columns of the 'items' table that are stored in the item's attributes
+    item_columns = ('kg_id', 'imdb_id', 'orig_title', 'aka_title', 'director',
+                    'year', 'country', 'torrent', 'source', 'subtitles',
+                    'language', 'media_type')
+
+    item_insert = """insert into items (%s) values (%s);""" % (
+        ', '.join(item_columns), ', '.join('?'*len(item_columns)))
+
+    # Maximum number of host parameters SQLite allows in a single statement
+    max_params = 999
+
+    journal_modes = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+    synchronous_levels = ('off', 'normal', 'full', 'extra')
+
+    def __init__(self, db_file, journal_mode=None, synchronous=None):
+        """ Open the database, creating it if necessary. `journal_mode` and
+            `synchronous` set the SQLite pragmas of the same name, e.g. 'wal'
+            lets readers access the database while items are being stored,
+            and 'normal' avoids most syncs to disk in that mode.
+        """
         self.logger = logging.getLogger('pyragarga.LocalDatabase')
         db_exists = os.path.exists(db_file)
+        self.db_file = db_file
         self.conn = sqlite3.connect(db_file)
+        self._thread = threading.current_thread()
+        if journal_mode:
+            if journal_mode.lower() not in LocalDatabase.journal_modes:
+                raise PyragargaError("Invalid journal mode: %s" % journal_mode)
+            self.conn.execute("""pragma journal_mode = %s;""" % journal_mode)
+        if synchronous:
+            if synchronous.lower() not in LocalDatabase.synchronous_levels:
+                raise PyragargaError("Invalid synchronous level: %s"
+                                     % synchronous)
+            self.conn.execute("""pragma synchronous = %s;""" % synchronous)
         if not db_exists:
             self.logger.info('Database not existing, creating...')
-            self.conn.executescript(LocalDatabase.schema)
+        self._migrate()
+        self.has_fts = bool(self.conn.execute("""select 1 from sqlite_master
+            where name = 'items_fts';""").fetchone())
 
     def retrieve(self, kg_id):
         """ Retrieve item with the given KG-ID from the database. """
-        cursor = self.conn.cursor()
-        cursor.execute("""select * from items where kg_id = ?;""", (kg_id,))
-        result = cursor.fetchone()
-        if not result:
+        item = self.retrieve_many([kg_id]).get(int(kg_id))
+        if not item:
             raise PyragargaError("No item found.")
-        item = KGItem(*result)
-        cursor.execute("""select * from files where item_id = ?;""", (kg_id,))
-        item.files = [unicode(x[1]) for x in cursor.fetchall()]
-        # TODO: There must be a nicer way to do this
-        item.genres = item.genres[2:-2].split("', '")
-        self.logger.info("Succesfully retrieved item %d" % item.kg_id)
         return item
 
+    def retrieve_many(self, kg_ids):
+        """ Retrieve all items with the given KG-IDs from the database.
+            Returns a dictionary mapping the KG-IDs to the items, ids that
+            are not in the database are left out.
+        """
+        kg_ids = list(set(int(x) for x in kg_ids))
+        items = {}
+        cursor = self.conn.cursor()
+        # SQLite limits the number of parameters in a single query
+        for offset in range(0, len(kg_ids), LocalDatabase.max_params):
+            chunk = kg_ids[offset:offset+LocalDatabase.max_params]
+            placeholders = ', '.join('?'*len(chunk))
+            cursor.execute("""select %s from items where kg_id in (%s);"""
+                    % (', '.join(LocalDatabase.item_columns), placeholders),
+                    chunk)
+            for result in cursor.fetchall():
+                item = KGItem(**dict(zip(LocalDatabase.item_columns, result)))
+                items[item.kg_id] = item
+            cursor.execute("""select item_id, genre from item_genres
+                where item_id in (%s) order by item_id, position;"""
+                % placeholders, chunk)
+            genres = {}
+            for (item_id, genre) in cursor.fetchall():
+                genres.setdefault(item_id, []).append(genre)
+            for (item_id, item_genres) in genres.items():
+                items[item_id].genres = item_genres
+            cursor.execute("""select item_id, filename from files
+                where item_id in (%s) order by id;""" % placeholders, chunk)
+            for (item_id, filename) in cursor.fetchall():
+                items[item_id].files.append(unicode(filename))
+        self.logger.info("Succesfully retrieved %d of %d items"
+                % (len(items), len(kg_ids)))
+        return items
+
+    def retrieve_table(self, kg_ids=None):
+        """ Retrieve the items with the given KG-IDs, or all items, from the
+            database as an `ItemTable`.
+        """
+        if kg_ids is None:
+            kg_ids = [x[0] for x in self.conn.execute("""select kg_id
+                from items order by kg_id;""")]
+        kg_ids = list(kg_ids)
+        table = ItemTable()
+        # Only keep a few items around as objects at a time
+        for offset in range(0, len(kg_ids), LocalDatabase.max_params):
+            chunk = kg_ids[offset:offset+LocalDatabase.max_params]
+            items = self.retrieve_many(chunk)
+            table.extend(items[x] for x in chunk if x in items)
+        return table
+
     def store(self, item):
         """ Store given item in database."""
-        cursor = self.conn.cursor()
-        # Store the item
-        if item:
-            cursor.execute(*self._build_insert(item, 'items'))
-        for file_ in item.files:
-            cursor.execute("""insert into files (filename, item_id)
-                values (?, ?)""", (file_, item.kg_id))
-        self.conn.commit()
-        self.logger.info("Succesfully stored item %d" % item.kg_id)
+        self.store_many([item])
+
+    def store_many(self, items):
+        """ Store all given items in the database in a single transaction,
+            replacing items that are already stored. Of several items with
+            the same id, the last one is stored.
+        """
+        unique = collections.OrderedDict()
+        for item in items:
+            unique.pop(item.kg_id, None)
+            unique[item.kg_id] = item
+        items = unique.values()
+        kg_ids = [(x.kg_id,) for x in items]
+        with self.conn:
+            # Delete existing items explicitly instead of using 'insert or
+            # replace', which would not fire the triggers of the FTS tables
+            self.conn.executemany("""delete from item_genres
+                where item_id = ?;""", kg_ids)
+            self.conn.executemany("""delete from files where item_id = ?;""",
+                                  kg_ids)
+            self.conn.executemany("""delete from items where kg_id = ?;""",
+                                  kg_ids)
+            self.conn.executemany(LocalDatabase.item_insert,
+                ([getattr(item, x) for x in LocalDatabase.item_columns]
+                 for item in items))
+            self.conn.executemany("""insert into item_genres
+                (item_id, position, genre) values (?, ?, ?);""",
+                ((item.kg_id, position, genre) for item in items
+                 for (position, genre) in enumerate(item.genres)))
+            self.conn.executemany("""insert into files
+                (filename, basename, item_id) values (?, ?, ?);""",
+                ((file_, os.path.basename(file_), item.kg_id)
+                 for item in items for file_ in item.files))
+        self.logger.info("Succesfully stored %d items" % len(items))
+
+    def find_items(self, imdb_id=None, director=None, year=None, genre=None,
+                   country=None, title=None, limit=None):
+        """ Returns a list with all items in the database that match all of
+            the given criteria. `title` is searched for in the original and
+            the alternative titles.
+        """
+        conditions = []
+        params = []
+        for (column, value) in (('imdb_id', imdb_id), ('director', director),
+                                ('year', year), ('country', country)):
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                params.append(value)
+        if genre is not None:
+            conditions.append("""kg_id in (select item_id from item_genres
+                where genre = ?)""")
+            params.append(genre)
+        if title is not None:
+            if self.has_fts:
+                conditions.append("""kg_id in (select rowid from items_fts
+                    where items_fts match ?)""")
+                params.append(self._build_match(title))
+            else:
+                conditions.append("""(orig_title like ? or aka_title like ?)""")
+                params += ['%%%s%%' % title]*2
+        query = """select kg_id from items"""
+        if conditions:
+            query += """ where """ + ' and '.join(conditions)
+        query += """ order by kg_id"""
+        if limit is not None:
+            query += """ limit %d""" % limit
+        return self._retrieve_ordered(
+            [x[0] for x in self.conn.execute(query, params)])
+
+    def find_by_file(self, path):
+        """ Returns a list with all items containing a file with the name of
+            the file at the given path.
+        """
+        path = os.path.normpath(path)
+        kg_ids = [item_id for (item_id, filename) in self.conn.execute(
+            """select item_id, filename from files where basename = ?
+               order by item_id;""", (os.path.basename(path),))
+            # Files in subdirectories of a torrent must be in the same
+            # subdirectories on disk
+            if (path == os.path.normpath(filename) or
+                path.endswith(os.sep + os.path.normpath(filename)))]
+        return self._retrieve_ordered(kg_ids)
+
+    def search_files(self, text, limit=None):
+        """ Returns a list with all items containing files whose names
+            contain the given words, or the given text if full-text search
+            is not available.
+        """
+        if self.has_fts:
+            query = """select files.item_id from files_fts
+                join files on files.id = files_fts.rowid
+                where files_fts match ? order by rank"""
+            params = [self._build_match(text)]
+        else:
+            query = """select item_id from files where filename like ?"""
+            params = ['%%%s%%' % text]
+        kg_ids = []
+        for (kg_id,) in self.conn.execute(query, params):
+            if kg_id not in kg_ids:
+                kg_ids.append(kg_id)
+            if limit is not None and len(kg_ids) == limit:
+                break
+        return self._retrieve_ordered(kg_ids)
+
+    def iter_files(self):
+        """ Yields tuples with the ids of the items and the names of all
+            stored files.
+        """
+        for row in self.conn.execute("""select item_id, filename
+                from files;"""):
+            yield row
+
+    def get_last_synced(self, user_id):
+        """ Returns the id of the newest item snatched by the given user
+            when their snatched items were last synced, or None.
+        """
+        result = self.conn.execute("""select last_kg_id from sync_state
+            where user_id = ?;""", (int(user_id),)).fetchone()
+        return result[0] if result else None
+
+    def set_last_synced(self, user_id, kg_id, snatched_ids=()):
+        """ Records the id of the newest item snatched by the given user,
+            along with the ids of the items snatched since the last sync.
+        """
+        user_id = int(user_id)
+        with self.conn:
+            self.conn.executemany("""insert or ignore into snatched_items
+                (user_id, kg_id) values (?, ?);""",
+                ((user_id, x) for x in snatched_ids))
+            # The first sync records all snatched items
+            self.conn.execute("""insert or replace into sync_state
+                (user_id, last_kg_id, complete) values (?, ?, coalesce(
+                    (select complete from sync_state where user_id = ?), 1)
+                );""", (user_id, kg_id, user_id))
+
+    def get_snatched_ids(self, user_id):
+        """ Returns a set with the ids of the items snatched by the given
+            user up to the last sync, or None if they are not all recorded.
+        """
+        result = self.conn.execute("""select complete from sync_state
+            where user_id = ?;""", (int(user_id),)).fetchone()
+        if not result or not result[0]:
+            return None
+        return set(x for (x,) in self.conn.execute("""select kg_id
+            from snatched_items where user_id = ?;""", (int(user_id),)))
+
+    def set_snatched_ids(self, user_id, snatched_ids):
+        """ Records the ids of all items snatched by the given user, who
+            was synced before the ids were recorded.
+        """
+        user_id = int(user_id)
+        with self.conn:
+            self.conn.executemany("""insert or ignore into snatched_items
+                (user_id, kg_id) values (?, ?);""",
+                ((user_id, x) for x in snatched_ids))
+            self.conn.execute("""update sync_state set complete = 1
+                where user_id = ?;""", (user_id,))
+
+    def load_cookies(self):
+        """ Returns a dictionary with the saved session cookies. """
+        return dict(self.conn.execute("""select name, value
+            from session_cookies;""").fetchall())
+
+    def save_cookies(self, cookies):
+        """ Replaces the saved session cookies with the given dictionary.
+            Unlike the other methods, it may be called from any thread, as
+            the tracker may be logged into again while fetching pages.
+        """
+        conn = self.conn
+        if threading.current_thread() is not self._thread:
+            # SQLite connections may only be used by the thread that opened
+            # them
+            conn = sqlite3.connect(self.db_file)
+        try:
+            with conn:
+                conn.execute("""delete from session_cookies;""")
+                conn.executemany("""insert into session_cookies (name, value)
+                    values (?, ?);""", cookies.items())
+        finally:
+            if conn is not self.conn:
+                conn.close()
+
+    def _retrieve_ordered(self, kg_ids):
+        """ Retrieve the items with the given KG-IDs as a list in the same
+            order.
+        """
+        items = self.retrieve_many(kg_ids)
+        return [items[x] for x in kg_ids]
+
+    def _build_match(self, text):
+        """ Builds an FTS query that matches all words in the given text. """
+        return ' '.join('"%s"' % x.replace('"', '""') for x in text.split())
 
     def _run_query(self, query):
         """ Run a query on the database. """
@@ -418,17 +1915,161 @@ class LocalDatabase(object):
         cursor.execute(query)
         return cursor.fetchall()
 
-    def _build_insert(self, item, table):
-        # FIXME: Huge security gap, as this makes the application vulnerable
-        #        to SQL injection. I don't know how to construct queries with
-        #        a varying number of keys safely, though :-/
-        #        On top of that, the code is butt-ugly, but well...
-        keys = tuple(x for x in item.__dict__
-                if item.__dict__[x] and x != 'files')
-        values = tuple(unicode(item.__dict__[x]) for x in keys)
-        query = "insert into %s (%s) values (%s)" % (
-                    table, ', '.join(keys), ', '.join('?'*len(keys)))
-        return (query, values)
+    def _migrate(self):
+        """ Brings the database up to the current schema version. """
+        current_version = self.conn.execute("""pragma user_version;"""
+                                            ).fetchone()[0]
+        isolation_level = self.conn.isolation_level
+        # Handle the transactions ourselves, as the sqlite3 module would
+        # commit before every statement that changes the schema otherwise
+        self.conn.isolation_level = None
+        try:
+            for version in range(current_version + 1,
+                                 LocalDatabase.schema_version + 1):
+                self.logger.info('Migrating database to version %d' % version)
+                self.conn.execute("""begin;""")
+                try:
+                    getattr(self, '_migrate_to_%d' % version)()
+                    self.conn.execute("""pragma user_version = %d;"""
+                                      % version)
+                except:
+                    self.conn.execute("""rollback;""")
+                    raise
+                self.conn.execute("""commit;""")
+        finally:
+            self.conn.isolation_level = isolation_level
+
+    def _migrate_to_1(self):
+        """ Creates the original schema. Databases created before the schema
+            was versioned already have these tables.
+        """
+        self.conn.execute("""
+            create table if not exists items (
+                kg_id       integer primary key,
+                imdb_id     integer,
+                orig_title  text,
+                aka_title   text,
+                director    text,
+                year        text,
+                country     text,
+                torrent     blob,
+                genres      text,
+                source      text,
+                subtitles   text,
+                language    text,
+                media_type  text
+            );""")
+        self.conn.execute("""
+            create table if not exists files (
+                id          integer primary key,
+                filename    text,
+                item_id     integer not null references items(kg_id)
+            );""")
+
+    def _migrate_to_2(self):
+        """ Moves the genres from the 'genres' column, where they were stored
+            as the representation of a Python list, into their own table and
+            indexes the columns that items are looked up by.
+        """
+        self.conn.execute("""
+            create table item_genres (
+                item_id     integer not null references items(kg_id),
+                position    integer not null,
+                genre       text not null,
+                primary key (item_id, position)
+            );""")
+        for (kg_id, genres) in self.conn.execute("""select kg_id, genres
+                from items where genres is not null;""").fetchall():
+            try:
+                genres = ast.literal_eval(genres)
+            except (SyntaxError, ValueError):
+                self.logger.warning("Could not migrate genres of item %d"
+                                    % kg_id)
+                continue
+            self.conn.executemany("""insert into item_genres
+                (item_id, position, genre) values (?, ?, ?);""",
+                [(kg_id, position, genre)
+                 for (position, genre) in enumerate(genres)])
+        self.conn.execute("""update items set genres = null;""")
+        for statement in (
+                """create index files_item_id on files(item_id);""",
+                """create index items_imdb_id on items(imdb_id);""",
+                """create index items_director on items(director);""",
+                """create index items_year on items(year);""",
+                """create index item_genres_genre on item_genres(genre);"""):
+            self.conn.execute(statement)
+
+    def _migrate_to_3(self):
+        """ Adds the basenames of the files to look them up by and full-text
+            indexes of titles and file names, if SQLite supports FTS5.
+        """
+        self.conn.execute("""alter table files add column basename text;""")
+        for (file_id, filename) in self.conn.execute("""select id, filename
+                from files;""").fetchall():
+            self.conn.execute("""update files set basename = ?
+                where id = ?;""", (os.path.basename(filename), file_id))
+        self.conn.execute("""create index files_basename on files(basename);""")
+        try:
+            self.conn.execute("""create virtual table items_fts using fts5(
+                orig_title, aka_title, content='items', content_rowid='kg_id'
+                );""")
+        except sqlite3.OperationalError:
+            self.logger.warning('SQLite has no FTS5, full-text search will '
+                                'not be available')
+            return
+        self.conn.execute("""create virtual table files_fts using fts5(
+            filename, content='files', content_rowid='id');""")
+        for statement in (
+                """create trigger items_fts_insert after insert on items begin
+                    insert into items_fts (rowid, orig_title, aka_title)
+                    values (new.kg_id, new.orig_title, new.aka_title);
+                   end;""",
+                """create trigger items_fts_delete after delete on items begin
+                    insert into items_fts (items_fts, rowid, orig_title,
+                                           aka_title)
+                    values ('delete', old.kg_id, old.orig_title,
+                            old.aka_title);
+                   end;""",
+                """create trigger files_fts_insert after insert on files begin
+                    insert into files_fts (rowid, filename)
+                    values (new.id, new.filename);
+                   end;""",
+                """create trigger files_fts_delete after delete on files begin
+                    insert into files_fts (files_fts, rowid, filename)
+                    values ('delete', old.id, old.filename);
+                   end;""",
+                """insert into items_fts (items_fts) values ('rebuild');""",
+                """insert into files_fts (files_fts) values ('rebuild');"""):
+            self.conn.execute(statement)
+
+    def _migrate_to_4(self):
+        """ Adds the table recording the state of each user's last sync. """
+        self.conn.execute("""
+            create table sync_state (
+                user_id     integer primary key,
+                last_kg_id  integer not null
+            );""")
+
+    def _migrate_to_5(self):
+        """ Adds the table the cookies of the tracker session are saved in. """
+        self.conn.execute("""
+            create table session_cookies (
+                name        text primary key,
+                value       text
+            );""")
+
+    def _migrate_to_6(self):
+        """ Adds the table recording the ids of the items each user
+            snatched, which are only complete for users synced from now on.
+        """
+        self.conn.execute("""
+            create table snatched_items (
+                user_id     integer not null,
+                kg_id       integer not null,
+                primary key (user_id, kg_id)
+            );""")
+        self.conn.execute("""alter table sync_state
+            add column complete integer not null default 0;""")
 
 
 class PyragargaError(Exception):
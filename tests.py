@@ -1,5 +1,13 @@
 import os
-from pyragarga import Pyragarga
+import shutil
+import sys
+from pyragarga import (KGItem, LibraryMatcher, LocalDatabase, Pyragarga,
+                       ResponseCache, TorrentCache)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'benchmarks'))
+import fixtures
+from server import StandInTracker
 
 class TestPyragarga(object):
 
@@ -11,13 +19,29 @@ class TestPyragarga(object):
             os.remove('/tmp/pykg_test.db')
         except:
             pass
+        shutil.rmtree('/tmp/pykg_torrents', ignore_errors=True)
+        shutil.rmtree('/tmp/pykg_library', ignore_errors=True)
+        for path in ('/tmp/pykg_cache.db', '/tmp/pykg_cookies.json'):
+            try:
+                os.remove(path)
+            except:
+                pass
+
+    def test_persist_session(self):
+        first = Pyragarga('user', 'password',
+                          cookie_file='/tmp/pykg_cookies.json')
+        second = Pyragarga('user', 'password',
+                           cookie_file='/tmp/pykg_cookies.json')
+        assert second.user_id == first.user_id
+        assert second._login_count == 0
+        assert second.get_item(10593).kg_id == 10593
 
     def test_get_item(self):
         result = self.pyragarga.get_item(10593)
         assert result.kg_id == 10593
         assert result.orig_title == u"Chronik der Anna Magdalena Bach"
         assert result.aka_title == u"The Chronicle of Anna Magdalena Bach"
-        assert result.genres == ['Arthouse', 'Drama']
+        assert result.genres == ('Arthouse', 'Drama')
         assert ("Jean-Marie Straub(1968)-Chronicle of Anna Magdalena Bach(Chronik der Anna Magdalena Bach)[93.DVD]{Ugo Pi.avi"
                 in result.files)
         assert ("Straight.Shooting.(John.Ford, 1917).by.chainsaw[ci-cl].avi"
@@ -27,6 +51,38 @@ class TestPyragarga(object):
         assert ("Mad Max 3 - Beyond Thunderdome (1985) NTSC DVD5"
                 in self.pyragarga.get_item(26763).files)
 
+    def test_torrent_cache(self):
+        self.pyragarga._torrent_cache = TorrentCache('/tmp/pykg_torrents')
+        files = self.pyragarga.get_item(26763).files
+        assert "Mad Max 3 - Beyond Thunderdome (1985) NTSC DVD5" in files
+        assert len(os.listdir('/tmp/pykg_torrents')) == 1
+        assert self.pyragarga.get_item(26763).files == files
+
+    def test_response_cache(self):
+        cache = ResponseCache('/tmp/pykg_cache.db')
+        self.pyragarga._response_cache = cache
+        self.pyragarga.get_item(10593)
+        assert cache.lookup(
+            'https://karagarga.net/details.php?filelist=1&id=10593').fresh
+        result = self.pyragarga.get_item(10593)
+        assert result.orig_title == u"Chronik der Anna Magdalena Bach"
+
+    def test_stats(self):
+        events = []
+        pyragarga = Pyragarga('user', 'password', instrument=True,
+                              stats_hook=lambda *args: events.append(args))
+        pyragarga.get_item(10593)
+        stats = pyragarga.stats()
+        assert stats['counters']['http.requests'] >= 1
+        assert stats['timings']['parse.details_page']['count'] == 1
+        assert ('counter', 'http.requests', 1) in events
+        assert self.pyragarga.stats()['counters'] == {}
+
+    def test_get_items(self):
+        result = self.pyragarga.get_items([25906, 10593, 25906])
+        assert [x.kg_id for x in result] == [25906, 10593, 25906]
+        assert result[1].orig_title == u"Chronik der Anna Magdalena Bach"
+
     def test_search_simple(self):
         result = self.pyragarga.search('Violence.Without.A.Cause.1969.DVDRip.XviD-KG.avi')
         assert result[0].kg_id == 21776
@@ -43,13 +99,179 @@ class TestPyragarga(object):
         assert result[1].imdb_id == 101458
         assert len(result) == 25
 
+    def test_iter_snatched(self):
+        result = self.pyragarga.iter_snatched(user_id=29027)
+        assert next(result).kg_id == 3749
+        assert next(result).orig_title == u"Bis ans Ende der Welt"
+        assert len(list(result)) == 23
+
+    def test_get_bookmarks(self):
+        bookmarks = self.pyragarga.get_bookmarks(snatched=True)
+        unsnatched = self.pyragarga.get_bookmarks()
+        assert set(x.kg_id for x in unsnatched) <= set(x.kg_id for x in bookmarks)
+
+    def test_get_snatched_streaming(self):
+        self.pyragarga.stream_results = True
+        result = self.pyragarga.get_snatched(user_id=29027)
+        assert result[1].orig_title == u"Bis ans Ende der Welt"
+        assert len(result) == 25
+
     def test_persist_db(self):
         self.pyragarga.enable_db('/tmp/pykg_test.db')
         self.pyragarga.get_item(10593)
         assert self.pyragarga._database.retrieve(10593).orig_title == u"Chronik der Anna Magdalena Bach"
+        assert self.pyragarga._database.retrieve(10593).genres == ('Arthouse', 'Drama')
         assert ("Jean-Marie Straub(1968)-Chronicle of Anna Magdalena Bach(Chronik der Anna Magdalena Bach)[93.DVD]{Ugo Pi.avi"
                 in self.pyragarga._database.retrieve(10593).files)
         assert len(self.pyragarga._database._run_query(
             """select * from items;""")) == 1
         assert len(self.pyragarga._database._run_query(
             """select * from files;""")) == 1
+
+    def test_local_queries(self):
+        self.pyragarga.enable_db('/tmp/pykg_test.db')
+        self.pyragarga.get_items([10593, 131335])
+        database = self.pyragarga._database
+        assert [x.kg_id for x in database.find_items(genre='Arthouse')] == [10593]
+        assert database.find_items(title='Anna Magdalena')[0].kg_id == 10593
+        assert database.search_files('Seven Chances')[0].kg_id == 131335
+        assert database.find_by_file(
+            '/media/films/Seven.Chances.1925.BluRay.720p.DTS.x264-CHD.mkv'
+            )[0].kg_id == 131335
+
+    def test_match_library(self):
+        self.pyragarga.enable_db('/tmp/pykg_test.db')
+        self.pyragarga.get_item(131335)
+        os.makedirs('/tmp/pykg_library/films')
+        for filename in ('Seven.Chances.1925.BluRay.720p.DTS.x264-CHD.mkv',
+                         'Violence.Without.A.Cause.1969.DVDRip.XviD-KG.avi'):
+            open(os.path.join('/tmp/pykg_library/films', filename), 'w').close()
+        result = self.pyragarga.match_library('/tmp/pykg_library')
+        assert result['/tmp/pykg_library/films/Seven.Chances.1925.BluRay.720p.DTS.x264-CHD.mkv'].kg_id == 131335
+        assert result['/tmp/pykg_library/films/Violence.Without.A.Cause.1969.DVDRip.XviD-KG.avi'].kg_id == 21776
+
+    def test_persist_db_many(self):
+        self.pyragarga.enable_db('/tmp/pykg_test.db')
+        self.pyragarga.get_items([10593, 25906])
+        assert sorted(self.pyragarga._database.retrieve_many(
+            [10593, 25906, 1]).keys()) == [10593, 25906]
+
+
+class TestLibraryMatcher(object):
+
+    def setup(self):
+        self.database = LocalDatabase('/tmp/pykg_test.db')
+
+    def teardown(self):
+        os.remove('/tmp/pykg_test.db')
+        shutil.rmtree('/tmp/pykg_library', ignore_errors=True)
+
+    def test_scan_non_ascii(self):
+        item = KGItem(1, orig_title=u'Caf\xe9')
+        item.files = [u'Caf\xe9 (1963)/Caf\xe9.avi']
+        self.database.store(item)
+        os.makedirs('/tmp/pykg_library/Caf\xc3\xa9 (1963)')
+        path = '/tmp/pykg_library/Caf\xc3\xa9 (1963)/Caf\xc3\xa9.avi'
+        open(path, 'w').close()
+        result = LibraryMatcher(self.database).scan('/tmp/pykg_library')
+        assert result[path].kg_id == 1
+
+
+class TestStandIn(object):
+    """ Tests against the stand-in for the tracker from the benchmarks. """
+
+    def setup(self):
+        self.tracker = StandInTracker(num_pages=4, rows_per_page=20,
+                                      num_files=3).start()
+
+    def teardown(self):
+        self.tracker.stop()
+        try:
+            os.remove('/tmp/pykg_test.db')
+        except:
+            pass
+
+    def connect(self, **kwargs):
+        return Pyragarga('user', 'password', url=self.tracker.url,
+                         db_file='/tmp/pykg_test.db', **kwargs)
+
+    def test_session_expired(self):
+        pyragarga = self.connect(persist_session=True)
+        # Expires while the remaining pages are fetched concurrently
+        self.tracker.expire_session(after=1)
+        assert len(pyragarga.get_snatched(movies_only=False)) == 80
+        assert self.tracker.logins == 2
+        reused = self.connect(persist_session=True)
+        assert reused._login_count == 0
+        assert len(reused.get_snatched(movies_only=False)) == 80
+        assert self.tracker.logins == 2
+
+    def test_sync_snatched(self):
+        pyragarga = self.connect()
+        result = pyragarga.sync_snatched(movies_only=False)
+        assert [x.kg_id for x in result] == range(80, 0, -1)
+        assert pyragarga._database.get_last_synced(pyragarga.user_id) == 80
+        requests = self.tracker.requests
+        assert pyragarga.sync_snatched(movies_only=False) == []
+        assert self.tracker.requests == requests + 1
+        self.tracker.snatch(30)
+        requests = self.tracker.requests
+        result = pyragarga.sync_snatched(movies_only=False)
+        assert [x.kg_id for x in result] == range(110, 80, -1)
+        # The last synced item is on the second page, the ones after it
+        # aren't fetched
+        assert self.tracker.requests == requests + 2
+        assert pyragarga._database.get_last_synced(pyragarga.user_id) == 110
+
+    def test_sync_snatched_failed(self):
+        pyragarga = self.connect(retries=0)
+        pyragarga.sync_snatched(movies_only=False)
+        self.tracker.snatch(5)
+        self.tracker.unavailable.add('details.php')
+        try:
+            pyragarga.sync_snatched(grab_full=True)
+        except Exception:
+            pass
+        else:
+            raise AssertionError("Fetching the details didn't fail")
+        assert pyragarga._database.get_last_synced(pyragarga.user_id) == 80
+        self.tracker.unavailable.clear()
+        result = pyragarga.sync_snatched(grab_full=True)
+        assert [x.kg_id for x in result] == range(85, 80, -1)
+        assert result[0].imdb_id == 10085
+        assert pyragarga._database.get_last_synced(pyragarga.user_id) == 85
+
+    def test_get_bookmarks_synced(self):
+        pyragarga = self.connect()
+        assert len(pyragarga.get_bookmarks(snatched=True)) == 20
+        # Without a sync, the whole history of snatched items is fetched
+        requests = self.tracker.requests
+        unsnatched = pyragarga.get_bookmarks()
+        assert [x.kg_id for x in unsnatched] == range(90, 80, -1)
+        assert self.tracker.requests == requests + 5
+        pyragarga.sync_snatched(movies_only=False)
+        self.tracker.snatch(5)
+        requests = self.tracker.requests
+        unsnatched = pyragarga.get_bookmarks()
+        assert [x.kg_id for x in unsnatched] == range(90, 85, -1)
+        assert self.tracker.requests == requests + 2
+        assert (pyragarga._database.get_snatched_ids(pyragarga.user_id)
+                == set(range(1, 81)))
+        unsnatched = pyragarga.get_bookmarks(snatched_ids=[90])
+        assert [x.kg_id for x in unsnatched] == range(89, 70, -1)
+
+    def test_get_snatched_pipeline(self):
+        expected = [x.__getstate__() for x in
+                    self.connect().get_snatched(grab_full=True)]
+        os.remove('/tmp/pykg_test.db')
+        with self.connect(parse_processes=2) as pyragarga:
+            result = pyragarga.get_snatched(grab_full=True)
+            assert [x.__getstate__() for x in result] == expected
+            assert result[10].kg_id == 70
+            assert result[10].files == fixtures.multi_file_names(70, 3)
+            assert pyragarga._database.retrieve(70).files == result[10].files
+            # The processes are kept for the next operation
+            parse_pool = pyragarga._parse_pool
+            assert len(pyragarga.search('Title', num_pages=2)) == 40
+            assert pyragarga._parse_pool is parse_pool
+        assert pyragarga._parse_pool is None